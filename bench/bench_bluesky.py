@@ -0,0 +1,129 @@
+import asyncio
+
+import fixtures
+
+from stub import Measure, Request, StubServer, image, load_bot, mongo_client, parse_args, redirect, unique_jpeg
+
+
+SUBREDDIT = "vinesaucebench"
+ALBUM_SIZE = 50
+PHOTO = (4032, 3024)  # a phone photo, always needs a resize
+THUMB = (480, 360)
+
+
+def routes(stub: StubServer, posts: int) -> None:
+    fixtures.reddit(stub, SUBREDDIT)
+
+    photo = image(*PHOTO)
+    thumb = image(*THUMB, seed=1)
+
+    # albums, single images and videos, in about the mix the subreddit sees
+    children = []
+
+    for i in range(posts):
+        _id = f"b{i:05d}"
+
+        if i % 3 == 0:
+            children.append(fixtures.submission(SUBREDDIT, _id, url=f"https://imgur.com/a/album{i}"))
+        elif i % 3 == 1:
+            children.append(fixtures.submission(SUBREDDIT, _id, url=f"https://i.redd.it/{_id}.jpg"))
+        else:
+            children.append(fixtures.submission(SUBREDDIT, _id, url=f"https://youtu.be/{_id}", media={"oembed": {
+                "title": f"Video {_id}",
+                "provider_name": "YouTube",
+                "type": "video",
+                "author_name": "Vinesauce",
+                "thumbnail_url": f"https://i.ytimg.com/vi/{_id}/hqdefault.jpg",
+            }}))
+
+    @stub.route("GET", "oauth.reddit.com", rf"/r/{SUBREDDIT}/hot/?")
+    def hot(req: Request):
+        return fixtures.listing(children[:int(req.query.get("limit", 25))])
+
+    @stub.route("GET", "oauth.reddit.com", rf"/r/{SUBREDDIT}/rising/?")
+    def rising(req: Request):
+        return fixtures.listing([])
+
+    @stub.route("GET", "api.imgur.com", r"/3/album/(\w+)")
+    def album(req: Request):
+        album_id = req.match.group(1)
+
+        return 200, {"X-RateLimit-ClientRemaining": "12000", "X-RateLimit-UserRemaining": "2000"}, {
+            "data": {"images": [{"link": f"https://i.imgur.com/{album_id}x{n}.jpg"} for n in range(ALBUM_SIZE)]}
+        }
+
+    @stub.route("GET", "*", r"/(?:vi/)?([\w/]+)\.jpg")
+    def media(req: Request):
+        data = thumb if req.host == "i.ytimg.com" else photo
+        return 200, {"Content-Type": "image/jpeg"}, unique_jpeg(data, req.path)
+
+    @stub.route("POST", "bsky.social", r"/xrpc/com.atproto.server.createSession")
+    def create_session(req: Request):
+        token = fixtures.jwt(exp=2 ** 31, sub="did:plc:bench")
+        return {"accessJwt": token, "refreshJwt": token, "handle": "bench.bsky.social", "did": "did:plc:bench"}
+
+    @stub.route("GET", "bsky.social", r"/xrpc/app.bsky.actor.getProfile")
+    def profile(req: Request):
+        return {"did": "did:plc:bench", "handle": "bench.bsky.social", "avatar": "https://cdn.bsky.app/bench.jpg"}
+
+    @stub.route("POST", "bsky.social", r"/xrpc/com.atproto.repo.uploadBlob")
+    def upload_blob(req: Request):
+        return {"blob": {
+            "$type": "blob",
+            "ref": {"$link": f"bafkrei{abs(hash(req.body)):040d}"},
+            "mimeType": req.headers.get("Content-Type", "image/jpeg"),
+            "size": len(req.body),
+        }}
+
+    @stub.route("POST", "bsky.social", r"/xrpc/com.atproto.repo.createRecord")
+    def create_record(req: Request):
+        return {"uri": "at://did:plc:bench/app.bsky.feed.post/bench", "cid": "bafyreibench"}
+
+
+def main():
+    args = parse_args(["main", "send"])
+
+    posts = max(1, int(30 * args.scale))
+
+    bot = load_bot("bluesky", "bot", {
+        "REDDIT_CLIENT_ID": "bench",
+        "REDDIT_CLIENT_SECRET": "bench",
+        "REDDIT_REFRESH_TOKEN": "bench",
+        "BLUESKY_USERNAME": "bench.bsky.social",
+        "BLUESKY_PASSWORD": "bench",
+        "BLUESKY_TAGS": "vinesauce",
+        "IMGUR_CLIENT_ID": "bench",
+        "SUBREDDIT": SUBREDDIT,
+        "SCORE_THRESH": "10",
+        "SCAN_LIMIT": str(posts),
+        "POSTS_PER_RUN": str(posts),
+        "POST_SPACING": "0",
+    })
+
+    bot.mongo._obj = mongo_client(args.mongo)
+
+    params = {"posts": posts, "album_size": ALBUM_SIZE, "latency": args.latency, "mongo": "mongod" if args.mongo else "mongomock"}
+
+    with StubServer(args.latency) as stub:
+        routes(stub, posts)
+        redirect(stub)
+
+        if args.scenario == "main":
+            with Measure("bluesky.main", stub, **params):
+                asyncio.run(bot.main())
+
+        elif args.scenario == "send":
+            album = next(s for s in bot.reddit.subreddit(SUBREDDIT).hot(limit=1))
+
+            async def send():
+                try:
+                    await bot.send(album)
+                finally:
+                    await bot.http.aclose()
+
+            with Measure("bluesky.send", stub, **params):
+                asyncio.run(send())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+
+import yaml
+
+import fixtures
+
+from stub import ROOT, Measure, Request, StubServer, image, load_bot, parse_args, redirect
+
+
+SUBREDDIT = "vinesaucebench"
+WIDGET_ID = "widget_bench"
+LIVE_EVERY = 7  # one in this many friends is live
+S3_HOST = "reddit-subreddit-uploaded-media.s3-accelerate.amazonaws.com"
+
+
+def routes(stub: StubServer, friends: int) -> None:
+    fixtures.reddit(stub, SUBREDDIT)
+
+    logins = ["vinesauce"] + [f"friend{i:04d}" for i in range(friends)]
+    avatar = image(300, 300, format="PNG")
+
+    widget = {
+        "id": WIDGET_ID,
+        "kind": "custom",
+        "shortName": "Twitch",
+        "text": "",
+        "css": "",
+        "height": 400,
+        "imageData": [],
+        "styles": {"backgroundColor": "", "headerColor": ""},
+    }
+
+    @stub.route("GET", "oauth.reddit.com", rf"/r/{SUBREDDIT}/api/widgets/?")
+    def widgets(req: Request):
+        return {
+            "items": {WIDGET_ID: dict(widget)},
+            "layout": {"idCardWidget": "", "moderatorWidget": "", "sidebar": {"order": [WIDGET_ID]}, "topbar": {"order": []}},
+        }
+
+    @stub.route("PUT", "oauth.reddit.com", rf"/r/{SUBREDDIT}/api/widget/{WIDGET_ID}/?")
+    def update_widget(req: Request):
+        widget.update(json.loads(req.form()["json"]))
+        return dict(widget)
+
+    @stub.route("GET", "oauth.reddit.com", rf"/r/{SUBREDDIT}/wiki/bots/twitch/?")
+    def config(req: Request):
+        return {"kind": "wikipage", "data": {"content_md": yaml.dump({"friends": logins[1:]}), "revision_date": 0, "revision_by": None}}
+
+    @stub.route("POST", "oauth.reddit.com", rf"/r/{SUBREDDIT}/api/widget_image_upload_s3/?")
+    def lease(req: Request):
+        return {"s3UploadLease": {"action": f"//{S3_HOST}", "fields": [{"name": "key", "value": "bench/sprite.png"}]}}
+
+    @stub.route("POST", S3_HOST, r"/?")
+    def s3(req: Request):
+        return 201, {}, b""
+
+    @stub.route("POST", "id.twitch.tv", r"/oauth2/token")
+    def token(req: Request):
+        return {"access_token": "bench", "expires_in": 60 * 24 * 60 * 60, "token_type": "bearer"}
+
+    @stub.route("GET", "api.twitch.tv", r"/helix/users")
+    def users(req: Request):
+        return {"data": [{
+            "id": str(1000 + logins.index(login)),
+            "login": login,
+            "display_name": login.title(),
+            "type": "",
+            "broadcaster_type": "partner",
+            "description": "",
+            "profile_image_url": f"https://static-cdn.jtvnw.net/jtv_user_pictures/{login}-profile_image-300x300.png",
+            "offline_image_url": "",
+            "view_count": 0,
+            "created_at": "2015-01-01T00:00:00Z",
+        } for login in req.params.get("login", []) if login in logins]}
+
+    @stub.route("GET", "api.twitch.tv", r"/helix/streams")
+    def streams(req: Request):
+        return {"data": [{
+            "id": str(logins.index(login)),
+            "user_id": str(1000 + logins.index(login)),
+            "user_login": login,
+            "user_name": login.title(),
+            "game_id": "1",
+            "game_name": "Bench Simulator",
+            "type": "live",
+            "title": f"{login} benching",
+            "viewer_count": 1234,
+            "started_at": "2024-01-01T00:00:00Z",
+            "language": "en",
+            "thumbnail_url": "",
+            "tags": [],
+            "is_mature": False,
+        } for login in req.params.get("user_login", []) if logins.index(login) % LIVE_EVERY == 0], "pagination": {}}
+
+    @stub.route("GET", "static-cdn.jtvnw.net", r"/jtv_user_pictures/(.+)\.png")
+    def profile_image(req: Request):
+        etag = f'"{req.match.group(1)}"'
+
+        if req.headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+
+        return 200, {"Content-Type": "image/png", "ETag": etag}, avatar
+
+
+async def run(vt, scenario: str, stub: StubServer, params: dict) -> None:
+    await vt.CACHE_DIR.mkdir(exist_ok=True)
+
+    bot = await vt.VinesauceTwitch()
+
+    try:
+        if scenario == "update_streamers":
+            with Measure("twitch.update_streamers", stub, **params):
+                await bot.update_streamers()
+
+        elif scenario == "build_widget":
+            await bot.update_streamers()
+
+            with Measure("twitch.build_widget", stub, **params):
+                await bot.build_widget()
+
+            # avatars cached and the sprite already up
+            with Measure("twitch.build_widget.warm", stub, **params):
+                await bot.build_widget(update_sprite=True, update_css=True)
+
+        elif scenario == "update_widget":
+            await bot.update_streamers()
+
+            with Measure("twitch.update_widget", stub, **params):
+                await bot.update_widget()
+
+            with Measure("twitch.update_widget.unchanged", stub, **params):
+                await bot.update_widget()
+
+        elif scenario == "update":
+            # what one cron run does, against a streamer cache from a previous one
+            await bot.update_streamers()
+
+            with Measure("twitch.update", stub, **params):
+                await bot.build_widget()
+                await bot.run()
+
+    finally:
+        await bot.close()
+
+
+def main():
+    args = parse_args(["update_streamers", "build_widget", "update_widget", "update"])
+
+    friends = max(1, int(300 * args.scale))
+
+    # the bot keeps its cache and reads widget.scss relative to where it runs
+    workdir = tempfile.mkdtemp(prefix="bench-twitch-")
+    shutil.copy(ROOT / "twitch" / "widget.scss", workdir)
+    os.chdir(workdir)
+
+    vt = load_bot("twitch", "vinesauce_twitch", {
+        "TWITCH_CLIENT_ID": "bench",
+        "TWITCH_CLIENT_SECRET": "bench",
+        "REDDIT_CLIENT_ID": "bench",
+        "REDDIT_CLIENT_SECRET": "bench",
+        "REDDIT_REFRESH_TOKEN": "bench",
+        "SUBREDDIT": SUBREDDIT,
+        "WIDGET_ID": WIDGET_ID,
+    })
+
+    try:
+        with StubServer(args.latency) as stub:
+            routes(stub, friends)
+            redirect(stub)
+
+            asyncio.run(run(vt, args.scenario, stub, {"friends": friends, "latency": args.latency}))
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
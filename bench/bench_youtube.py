@@ -0,0 +1,114 @@
+from datetime import datetime as dt, timezone
+from xml.sax.saxutils import escape
+
+import fixtures
+
+from stub import Measure, Request, StubServer, load_bot, mongo_client, parse_args, redirect
+
+
+SUBREDDIT = "vinesaucebench"
+FEED_SIZE = 15  # youtube feeds carry the latest 15 uploads
+NEW_EVERY = 10  # one in this many channels has a new upload
+
+
+def videos(channel: int) -> list:
+    return [(f"v{channel:04d}x{n:02d}", f"Vinny - Video {n} [Vinesauce]") for n in range(FEED_SIZE)]
+
+def routes(stub: StubServer, channels: int) -> None:
+    fixtures.reddit(stub, SUBREDDIT)
+
+    now = dt.now(timezone.utc).isoformat()
+    submitted = []
+
+    @stub.route("GET", "www.youtube.com", r"/feeds/videos.xml")
+    def feed(req: Request):
+        channel_id = req.query["channel_id"]
+        etag = f'"{channel_id}"'
+
+        if req.headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+
+        entries = "".join(
+            f"<entry><yt:videoId>{v}</yt:videoId><yt:channelId>{channel_id}</yt:channelId><title>{escape(title)}</title>"
+            f"<author><name>Vinesauce</name></author><published>{now}</published></entry>"
+            for v, title in videos(int(channel_id[2:]))
+        )
+
+        xml = f'<feed xmlns="http://www.w3.org/2005/Atom" xmlns:yt="http://www.youtube.com/xml/schemas/2015">{entries}</feed>'
+
+        return 200, {"Content-Type": "application/atom+xml", "ETag": etag}, xml
+
+    @stub.route("GET", "*", r"/youtube/v3/videos")
+    def videos_list(req: Request):
+        return {"items": [{"id": v, "snippet": {"title": f"Confirmed {v}", "channelTitle": "Vinesauce"}} for v in req.query["id"].split(",")]}
+
+    @stub.route("GET", "*", r"/youtube/v3/activities")
+    def activities_list(req: Request):
+        return {"items": [{
+            "snippet": {"type": "upload", "title": title, "channelTitle": "Vinesauce"},
+            "contentDetails": {"upload": {"videoId": v}},
+        } for v, title in videos(int(req.query["channelId"][2:]))]}
+
+    @stub.route("POST", "oauth.reddit.com", r"/api/submit/?")
+    def submit(req: Request):
+        _id = f"s{len(submitted):05d}"
+        submitted.append(_id)
+
+        return {"json": {"errors": [], "data": {"url": f"https://www.reddit.com/r/{SUBREDDIT}/comments/{_id}/", "id": _id, "name": f"t3_{_id}"}}}
+
+    @stub.route("GET", "oauth.reddit.com", rf"/r/{SUBREDDIT}/hot/?")
+    def hot(req: Request):
+        return fixtures.listing([
+            fixtures.submission(SUBREDDIT, f"sticky{i}", stickied=True, author=fixtures.BOT_USER) for i in range(2)
+        ])
+
+    @stub.route("POST", "oauth.reddit.com", r"/api/set_subreddit_sticky/?")
+    def sticky(req: Request):
+        return {"json": {"errors": []}}
+
+
+def main():
+    args = parse_args(["main", "main.api"])
+
+    channels = max(1, int(200 * args.scale))
+
+    yt = load_bot("youtube", "vinesauce_youtube", {
+        "REDDIT_CLIENT_ID": "bench",
+        "REDDIT_CLIENT_SECRET": "bench",
+        "REDDIT_REFRESH_TOKEN": "bench",
+        "DEVELOPER_KEY": "bench",
+        "SUBREDDIT": SUBREDDIT,
+        "FLAIR_ID": "bench",
+    })
+
+    yt.CHANNELS = [{"id": f"UC{i:04d}", "name": f"Channel {i}", "title_sub": ["Vinny -"]} for i in range(channels)]
+    yt.mongo._obj = mongo_client(args.mongo)
+
+    # everything but the newest upload on every tenth channel was posted already
+    yt.SeenStore(yt.db).add_many(
+        v for i in range(channels) for n, (v, _) in enumerate(videos(i)) if n or i % NEW_EVERY
+    )
+
+    params = {"channels": channels, "latency": args.latency, "mongo": "mongod" if args.mongo else "mongomock"}
+
+    with StubServer(args.latency) as stub:
+        routes(stub, channels)
+        redirect(stub)
+
+        if args.scenario == "main":
+            with Measure("youtube.main", stub, **params):
+                yt.main()
+
+            # every feed answers 304 now
+            with Measure("youtube.main.unchanged", stub, **params):
+                yt.main()
+
+        elif args.scenario == "main.api":
+            yt.DISCOVERY = "api"
+
+            with Measure("youtube.main.api", stub, **params):
+                yt.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import json
+import time
+import base64
+
+from typing import List
+
+from stub import Request, StubServer
+
+
+BOT_USER = "vinesaucebot"
+
+
+def reddit(stub: StubServer, subreddit: str) -> None:
+    """The reddit endpoints every bot touches, tokens, the bot account and the subreddit itself"""
+
+    @stub.route("POST", "www.reddit.com", r"/api/v1/access_token/?")
+    def access_token(req: Request):
+        return {"access_token": "bench", "expires_in": 24 * 60 * 60, "scope": "*", "token_type": "bearer"}
+
+    @stub.route("GET", "oauth.reddit.com", r"/api/v1/me/?")
+    def me(req: Request):
+        return {"name": BOT_USER, "id": "bench"}
+
+    @stub.route("GET", "oauth.reddit.com", rf"/r/{subreddit}/about/?")
+    def about(req: Request):
+        return {"kind": "t5", "data": {"display_name": subreddit, "id": "bench", "name": "t5_bench"}}
+
+def submission(subreddit: str, _id: str, **data) -> dict:
+    return {"kind": "t3", "data": {
+        "id": _id,
+        "name": f"t3_{_id}",
+        "title": f"Bench post {_id}",
+        "url": f"https://www.reddit.com/r/{subreddit}/comments/{_id}/",
+        "permalink": f"/r/{subreddit}/comments/{_id}/bench/",
+        "subreddit": subreddit,
+        "author": "someone",
+        "score": 100,
+        "stickied": False,
+        "is_self": False,
+        "media": None,
+        "created_utc": time.time(),
+        **data,
+    }}
+
+def listing(children: List[dict]) -> dict:
+    return {"kind": "Listing", "data": {"after": None, "before": None, "children": children}}
+
+def jwt(**payload) -> str:
+    def encode(d: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).rstrip(b"=").decode()
+
+    return ".".join([encode({"alg": "none", "typ": "JWT"}), encode(payload), "YmVuY2g"])
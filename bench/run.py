@@ -0,0 +1,95 @@
+"""
+Offline benchmarks for the bots, every external service is answered by a local stub.
+
+    python bench/run.py                          # everything
+    python bench/run.py twitch youtube.main      # by bot, or single scenarios
+    python bench/run.py --latency 0.1 --scale 2  # slower services, bigger subreddit
+    python bench/run.py --save baseline.json
+    python bench/run.py --compare baseline.json
+
+Each scenario runs in its own process so peak rss is its own. Needs the bots'
+dependencies installed, plus mongomock unless --mongo points at a throwaway mongod.
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+from pathlib import Path
+
+
+HERE = Path(__file__).resolve().parent
+
+SCENARIOS = {
+    "bluesky": ["main", "send"],
+    "twitch": ["update_streamers", "build_widget", "update_widget", "update"],
+    "youtube": ["main", "main.api"],
+}
+
+
+def run(bot: str, scenario: str, args: argparse.Namespace) -> list:
+    cmd = [sys.executable, str(HERE / f"bench_{bot}.py"), scenario, "--latency", str(args.latency), "--scale", str(args.scale)]
+
+    if args.mongo:
+        cmd += ["--mongo", args.mongo]
+
+    p = subprocess.run(cmd, capture_output=True, text=True, timeout=args.timeout)
+
+    results = [json.loads(line[6:]) for line in p.stdout.splitlines() if line.startswith("BENCH ")]
+
+    if p.returncode or args.verbose:
+        print(p.stdout + p.stderr, file=sys.stderr)
+
+    if p.returncode:
+        results.append({"scenario": f"{bot}.{scenario}", "ok": False})
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("only", nargs="*", help="bots or bot.scenario to run")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--mongo")
+    parser.add_argument("--timeout", type=float, default=15 * 60)
+    parser.add_argument("--save", help="write the results here")
+    parser.add_argument("--compare", help="results from an earlier --save to compare against")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the bots' output")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        baseline = {r["scenario"]: r for r in json.loads(Path(args.compare).read_text())}
+
+    results = []
+
+    print(f"{'scenario':32} {'wall s':>9} {'requests':>9} {'rss mb':>8}")
+
+    for bot, scenarios in SCENARIOS.items():
+        for scenario in scenarios:
+            if args.only and bot not in args.only and f"{bot}.{scenario}" not in args.only:
+                continue
+
+            for r in run(bot, scenario, args):
+                results.append(r)
+
+                if not r["ok"]:
+                    print(f"{r['scenario']:32} FAILED")
+                    continue
+
+                line = f"{r['scenario']:32} {r['wall']:9.3f} {r['requests']:9d} {r['peak_rss_mb']:8.1f}"
+
+                if b := baseline.get(r["scenario"]):
+                    line += f"   {r['wall'] - b['wall']:+.3f}s {r['requests'] - b['requests']:+d} req {r['peak_rss_mb'] - b['peak_rss_mb']:+.1f}mb"
+
+                print(line, flush=True)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+
+    sys.exit(0 if all(r["ok"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import importlib
+import threading
+
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class Request(object):
+    def __init__(self, method: str, host: str, path: str, params: Dict[str, List[str]], headers, body: bytes, match: re.Match) -> None:
+        self.method = method
+        self.host = host
+        self.path = path
+        self.params = params  # every value, for repeated keys
+        self.query = {k: v[0] for k, v in params.items()}
+        self.headers = headers
+        self.body = body
+        self.match = match
+
+    def json(self):
+        return json.loads(self.body)
+
+    def form(self) -> Dict[str, str]:
+        return {k: v[0] for k, v in parse_qs(self.body.decode(errors="replace")).items()}
+
+
+class StubServer(object):
+    """Answers every request the bots make, routed on the host they think they are talking to"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.routes: List[Tuple[str, str, re.Pattern, Callable]] = []
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            # headers and body go out in one write, twitchAPI reads its token response after closing the session
+            wbufsize = -1
+
+            def _read_body(self) -> bytes:
+                if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+                    length = int(self.headers.get("Content-Length") or 0)
+                    return self.rfile.read(length) if length else b""
+
+                body = b""
+
+                while size := int(self.rfile.readline().split(b";")[0], 16):
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+
+                self.rfile.readline()
+
+                return body
+
+            def _handle(self):
+                body = self._read_body()
+
+                status, headers, payload = stub.dispatch(self.command, self.headers.get("Host", ""), self.path, self.headers, body)
+
+                self.send_response(status)
+
+                for k, v in headers.items():
+                    self.send_header(k, v)
+
+                self.send_header("Content-Length", str(len(payload)))
+
+                # say so, or aiohttp puts the connection back in its pool
+                if self.close_connection:
+                    self.send_header("Connection", "close")
+
+                self.end_headers()
+
+                if self.command != "HEAD":
+                    self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+        self.port = self.server.server_port
+
+    def __enter__(self) -> "StubServer":
+        threading.Thread(target=self.server.serve_forever, name="stub", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, method: str, host: str, pattern: str):
+        def decorator(func):
+            self.routes.append((method, host, re.compile(pattern), func))
+            return func
+
+        return decorator
+
+    def dispatch(self, method: str, host: str, raw_path: str, headers, body: bytes) -> Tuple[int, dict, bytes]:
+        host = host.split(":")[0]
+        url = urlsplit(raw_path)
+
+        with self._lock:
+            self.requests[host] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        for m, h, pattern, func in self.routes:
+            if m != method or h not in ("*", host):
+                continue
+
+            if match := pattern.fullmatch(url.path):
+                return respond(func(Request(method, host, url.path, parse_qs(url.query), headers, body, match)))
+
+        print(f"stub: no route for {method} {host}{url.path}", file=sys.stderr)
+
+        return 404, {"Content-Type": "application/json"}, b'{"error": 404}'
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests.clear()
+
+
+def respond(result) -> Tuple[int, dict, bytes]:
+    if isinstance(result, tuple):
+        status, headers, body = result
+    else:
+        status, headers, body = 200, {}, result
+
+    if isinstance(body, (dict, list)):
+        headers = {"Content-Type": "application/json", **headers}
+        body = json.dumps(body)
+
+    if isinstance(body, str):
+        body = body.encode()
+
+    return status, headers, body
+
+
+def redirect(stub: StubServer) -> None:
+    """Points every http client the bots use at the stub, keeping the real host in the Host header"""
+
+    def rewrite(url: str) -> Tuple[str, str]:
+        u = urlsplit(url)
+        return urlunsplit(("http", f"127.0.0.1:{stub.port}", u.path, u.query, "")), u.netloc
+
+    try:
+        import requests.adapters
+
+        send = requests.adapters.HTTPAdapter.send
+
+        def requests_send(self, request, *args, **kwargs):
+            request.url, request.headers["Host"] = rewrite(request.url)
+            return send(self, request, *args, **kwargs)
+
+        requests.adapters.HTTPAdapter.send = requests_send
+
+    except ImportError:
+        pass
+
+    try:
+        import httpx
+
+        handle = httpx.AsyncHTTPTransport.handle_async_request
+
+        async def httpx_handle(self, request):
+            # the Host header was already set from the original url
+            request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=stub.port)
+            return await handle(self, request)
+
+        httpx.AsyncHTTPTransport.handle_async_request = httpx_handle
+
+    except ImportError:
+        pass
+
+    try:
+        import aiohttp
+
+        _request = aiohttp.ClientSession._request
+
+        def aiohttp_request(self, method, str_or_url, **kwargs):
+            url, host = rewrite(str(str_or_url))
+            kwargs["headers"] = {**dict(kwargs.get("headers") or {}), "Host": host}
+            return _request(self, method, url, **kwargs)
+
+        aiohttp.ClientSession._request = aiohttp_request
+
+    except ImportError:
+        pass
+
+    try:
+        import httplib2
+
+        http_request = httplib2.Http.request
+
+        def httplib2_request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+            uri, host = rewrite(uri)
+            return http_request(self, uri, method, body, {**(headers or {}), "host": host}, *args, **kwargs)
+
+        httplib2.Http.request = httplib2_request
+
+    except ImportError:
+        pass
+
+
+def image(width: int, height: int, format: str = "JPEG", seed: int = 0) -> bytes:
+    # noise, so it compresses about as badly as a real photo
+    rng = random.Random(seed)
+    small = Image.frombytes("RGB", (64, 64), bytes(rng.getrandbits(8) for _ in range(64 * 64 * 3)))
+
+    fp = BytesIO()
+    small.resize((width, height), Image.BICUBIC).save(fp, format=format, quality=95)
+
+    return fp.getvalue()
+
+def unique_jpeg(data: bytes, tag: str) -> bytes:
+    # same pixels, different bytes, so content hashing doesnt dedupe the fixtures
+    comment = tag.encode()[:60000]
+    return data[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + data[2:]
+
+
+class Measure(object):
+    """Wall time, stub request count and peak rss of the block it wraps"""
+
+    def __init__(self, name: str, stub: StubServer, **params) -> None:
+        self.name = name
+        self.stub = stub
+        self.params = params
+
+    def __enter__(self) -> "Measure":
+        self.stub.reset()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        wall = time.perf_counter() - self.started
+
+        result = {
+            "scenario": self.name,
+            "wall": round(wall, 3),
+            "requests": sum(self.stub.requests.values()),
+            "hosts": dict(self.stub.requests.most_common()),
+            # linux reports kilobytes, each scenario runs in its own process so this is its own peak
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "params": self.params,
+            "ok": exc[0] is None,
+        }
+
+        print("BENCH " + json.dumps(result), flush=True)
+
+
+def parse_args(scenarios: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", choices=scenarios)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub waits before every response")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the number of posts, friends and channels")
+    parser.add_argument("--mongo", help="uri of a throwaway mongod, otherwise mongomock, which scans every collection it filters")
+
+    return parser.parse_args()
+
+def load_bot(directory: str, module: str, env: Dict[str, str]):
+    # the bots read their config at import time
+    os.environ.update(env)
+    sys.path.insert(0, str(ROOT / directory))
+
+    return importlib.import_module(module)
+
+def mongo_client(uri: str = None):
+    if uri:
+        import pymongo
+
+        client = pymongo.MongoClient(uri)
+        client.drop_database("vinesauce")
+
+        return client
+
+    import mongomock
+
+    return mongomock.MongoClient()
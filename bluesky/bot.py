@@ -1,19 +1,33 @@
+from __future__ import annotations
+
 import os
+import sys
+
+# the images copy common/ in next to the bot, in a checkout it is one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from common.lazy import Lazy, lazy_import, timing
+
 import re
+import time
+import random
+import asyncio
+import hashlib
 import logging
 import traceback
 
 from io import BytesIO
+from typing import List, Optional, Tuple
+from contextlib import asynccontextmanager
 
 import praw
+import httpx
 import pymongo
-import requests
-
-import atproto
-from atproto import client_utils, models
 
-from PIL import Image
-from discord_webhook import DiscordWebhook, DiscordEmbed
+from common.seen import SeenStore
+from common.stats import StatsSink
+from common.metrics import Metrics, service
+from common.instrument import MongoTimings, timed_session
 
 
 log = logging.getLogger(__name__)
@@ -25,6 +39,18 @@ formatter = logging.Formatter('[%(levelname)s] %(message)s')
 ch.setFormatter(formatter)
 log.addHandler(ch)
 
+# the shared modules log through the same handler
+logging.getLogger("common").setLevel(logging.DEBUG)
+logging.getLogger("common").addHandler(ch)
+
+
+# heavy, and not needed unless theres something to post
+atproto = lazy_import("atproto")
+client_utils = Lazy("client_utils", lambda: atproto.client_utils)
+models = Lazy("models", lambda: atproto.models)
+atproto_errors = lazy_import("atproto.exceptions")
+Image = lazy_import("PIL.Image")
+
 MAX_LEN = 300
 
 MONGO_URI = os.environ.get("MONGO_URI")
@@ -43,41 +69,422 @@ SUBREDDIT = os.environ.get("SUBREDDIT")
 SCORE_THRESH = os.environ.get("SCORE_THRESH")
 
 STATS_WH = os.environ.get("STATS_WH")
+STATS_QUEUE = os.environ.get("STATS_QUEUE")  # optional file to keep unsent stats in between runs
+
+METRICS_FILE = os.environ.get("METRICS_FILE")  # prometheus textfile written at exit
+
+HTTP_TIMEOUT = (5, 30)  # connect, read
+HTTP_RETRIES = 3
+HTTP_POOL_SIZE = 4  # connections kept per host
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_MAX_RETRY_AFTER = 30  # seconds, a server asking for a longer wait gets the error instead
+
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 4))
+
+MAX_IMAGES = 4  # per post
+MAX_DIM = 2000
+MAX_SIZE = 1E6
 
-reddit = praw.Reddit(
+MAX_FETCH_SIZE = int(os.environ.get("MAX_FETCH_SIZE", 32 * 1024 * 1024))
+MAX_PIXELS = 8000 * 8000
+FETCH_CHUNK_SIZE = 64 * 1024
+SNIFF_SIZE = 256 * 1024  # give up looking for the image header after this many bytes
+
+JPEG_QUALITY_MIN = 40
+JPEG_QUALITY_MAX = 90
+MAX_ENCODE_ATTEMPTS = 6
+MAX_RESIZE_ATTEMPTS = 3  # downscales at the lowest quality before an image is left out
+
+IMGUR_CACHE_TTL = int(os.environ.get("IMGUR_CACHE_TTL", 7 * 24 * 60 * 60))
+IMGUR_MIN_CREDITS = int(os.environ.get("IMGUR_MIN_CREDITS", 100))  # stop calling imgur when either budget drops below this
+IMGUR_CLIENT_BACKOFF = 60 * 60  # imgur doesnt say when client credits come back, wait this long before trying again
+
+SEEN_CACHE = os.environ.get("SEEN_CACHE")  # optional file of ids known to be posted, saves asking mongo
+
+SCAN_LIMIT = int(os.environ.get("SCAN_LIMIT", 25))  # per listing, hot and rising
+POSTS_PER_RUN = int(os.environ.get("POSTS_PER_RUN", 3))  # also the token bucket size
+POST_SPACING = int(os.environ.get("POST_SPACING", 60))  # seconds between posts, and per token refill
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", 5))
+RETRY_BACKOFF = 5 * 60  # seconds, doubled per failed attempt
+CLAIM_TTL = POST_SPACING + 10 * 60  # seconds a run holds a queue item while it waits and posts, so overlapping runs skip it
+
+metrics = Metrics(bot="bluesky")
+
+
+reddit = Lazy("reddit", lambda: praw.Reddit(
     client_id=REDDIT_CLIENT_ID,
     client_secret=REDDIT_CLIENT_SECRET,
     refresh_token=REDDIT_REFRESH_TOKEN,
-    user_agent="Vinesauce BlueSky bot /u/RenegadeAI"
-)
+    user_agent="Vinesauce BlueSky bot /u/RenegadeAI",
+    requestor_kwargs={"session": timed_session(metrics)},
+))
+
+mongo = Lazy("mongo", lambda: pymongo.MongoClient(MONGO_URI, event_listeners=[MongoTimings(metrics)]))
+db = Lazy("db", lambda: mongo.vinesauce.bluesky)
+imgur_cache = Lazy("imgur_cache", lambda: mongo.vinesauce.imgur)
+sessions = Lazy("sessions", lambda: mongo.vinesauce.sessions)
+queue = Lazy("queue", lambda: mongo.vinesauce.bluesky_queue)
+state = Lazy("state", lambda: mongo.vinesauce.bluesky_state)
+blob_cache = Lazy("blob_cache", lambda: mongo.vinesauce.bluesky_blobs)
+
+stats = Lazy("stats", lambda: StatsSink(STATS_WH, queue_file=STATS_QUEUE))
+
+
+async def save_session(event: atproto.SessionEvent, session: atproto.Session) -> None:
+    if event in (atproto.SessionEvent.CREATE, atproto.SessionEvent.REFRESH):
+        log.debug(f"Saving bluesky session ({event})")
+        await asyncio.to_thread(sessions.update_one, {"_id": BLUESKY_USERNAME}, {"$set": {"session": session.export()}}, upsert=True)
+
+async def login_bluesky() -> atproto.AsyncClient:
+    client = atproto.AsyncClient()
+    client.on_session_change(save_session)
+
+    if saved := await asyncio.to_thread(sessions.find_one, {"_id": BLUESKY_USERNAME}):
+        try:
+            # refreshes the tokens if the access token has expired
+            with metrics.request("bluesky", "resume_session"):
+                await client.login(session_string=saved["session"])
+            log.debug("Resumed bluesky session")
+
+            return client
+
+        except Exception as e:
+            log.warning(f"Could not resume bluesky session, logging in: {e}")
+
+    with metrics.request("bluesky", "login"):
+        await client.login(BLUESKY_USERNAME, BLUESKY_PASSWORD)
+
+    return client
+
+_bluesky = None
+
+async def get_bluesky() -> atproto.AsyncClient:
+    global _bluesky
+
+    if _bluesky is None:
+        _bluesky = await login_bluesky()
+        timing("bluesky ready")
+
+    return _bluesky
+
+
+http = Lazy("http", lambda: httpx.AsyncClient(
+    timeout=httpx.Timeout(HTTP_TIMEOUT[1], connect=HTTP_TIMEOUT[0]),
+    transport=httpx.AsyncHTTPTransport(retries=HTTP_RETRIES),  # connection errors only
+    follow_redirects=True,
+))
+
+host_limits = {}
+
+# background work that shouldnt hold up posting, awaited before exit
+background = set()
+
+@asynccontextmanager
+async def http_stream(method: str, url: str, **kwargs):
+    host = httpx.URL(url).host
+
+    if host not in host_limits:
+        host_limits[host] = asyncio.Semaphore(HTTP_POOL_SIZE)
+
+    labels = {"service": service(host), "op": host}
+
+    async with host_limits[host]:
+        for attempt in range(HTTP_RETRIES + 1):
+            started = time.perf_counter()
+
+            try:
+                async with http.stream(method, url, **kwargs) as response:
+                    # time to headers, the body is read by the caller
+                    metrics.observe("vinesauce_request_duration_seconds", time.perf_counter() - started, **labels)
+
+                    if response.is_error:
+                        metrics.inc("vinesauce_request_errors_total", **labels)
+
+                    retry_after = response.headers.get("Retry-After", "")
+
+                    # a long wait would hold up the run and this hosts other requests
+                    too_long = retry_after.isdigit() and int(retry_after) > HTTP_MAX_RETRY_AFTER
+
+                    if response.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES or too_long:
+                        yield response
+                        return
+
+            except httpx.TransportError:
+                metrics.inc("vinesauce_request_errors_total", **labels)
+                raise
 
-bluesky = atproto.Client()
-bluesky.login(BLUESKY_USERNAME, BLUESKY_PASSWORD)
+            delay = int(retry_after) if retry_after.isdigit() else 0.5 * 2 ** attempt + random.uniform(0, 0.5)
 
-mongo = pymongo.MongoClient(MONGO_URI)
-db = mongo.vinesauce.bluesky
+            log.debug(f"{response.status_code} from {host}, retrying in {delay:.1f}s")
 
-def main():
-    for submission in reversed(list(reddit.subreddit(SUBREDDIT).hot(limit=7))):
-        if submission.stickied or submission.score >= int(SCORE_THRESH):
+            await asyncio.sleep(delay)
 
-            if db.find_one({"id": submission.id}):
-                log.debug(f"Skipping {submission.id}")
+def run_in_background(coro) -> None:
+    task = asyncio.create_task(coro)
+
+    background.add(task)
+    task.add_done_callback(background.discard)
+
+
+class TokenBucket(object):
+    """Post tokens kept in mongo, only ever changed with conditional updates so overlapping runs cant spend the same one"""
+
+    def __init__(self, capacity: int, interval: float) -> None:
+        self.capacity = capacity
+        self.interval = interval
+
+        if interval:
+            state.update_one({"_id": "bucket"}, {"$setOnInsert": {"tokens": capacity, "updated_at": time.time()}}, upsert=True)
+        else:
+            state.update_one({"_id": "bucket"}, {"$set": {"tokens": capacity, "updated_at": time.time()}}, upsert=True)
+
+    def _refill(self) -> None:
+        if not self.interval:
+            return
+
+        doc = state.find_one({"_id": "bucket"})
+
+        now = time.time()
+        earned = (now - doc["updated_at"]) / self.interval
+
+        if earned <= 0:
+            return
+
+        # only the run that moves updated_at gets to add what was earned since
+        added = state.update_one(
+            {"_id": "bucket", "updated_at": doc["updated_at"]},
+            {"$inc": {"tokens": earned}, "$set": {"updated_at": now}},
+        ).modified_count
+
+        if added:
+            state.update_one({"_id": "bucket", "tokens": {"$gt": self.capacity}}, {"$set": {"tokens": self.capacity}})
+
+    def take(self) -> bool:
+        self._refill()
+
+        return state.update_one({"_id": "bucket", "tokens": {"$gte": 1}}, {"$inc": {"tokens": -1}}).modified_count == 1
+
+    def refund(self) -> None:
+        state.update_one({"_id": "bucket", "tokens": {"$lte": self.capacity - 1}}, {"$inc": {"tokens": 1}})
+
+
+def enqueue(store: SeenStore, listing: list) -> Tuple[dict, List[dict]]:
+    scanned = {}
+    for s in listing:
+        if s.stickied or s.score >= int(SCORE_THRESH):
+            scanned[s.id] = s
+
+    new = set(scanned) - store.seen(scanned)
+    items = [{"_id": _id, "created_utc": scanned[_id].created_utc, "attempts": 0, "next_attempt": 0} for _id in new]
+
+    if items:
+        queue.bulk_write([
+            pymongo.UpdateOne({"_id": x["_id"]}, {"$setOnInsert": {k: v for k, v in x.items() if k != "_id"}}, upsert=True)
+            for x in items
+        ], ordered=False)
+
+    return scanned, items
+
+async def main():
+    timing("main started")
+
+    sub = reddit.subreddit(SUBREDDIT)
+
+    # the listings, seen store and bucket dont depend on each other
+    store, hot, rising, bucket = await asyncio.gather(
+        asyncio.to_thread(SeenStore, db, SEEN_CACHE),
+        asyncio.to_thread(lambda: list(sub.hot(limit=SCAN_LIMIT))),
+        asyncio.to_thread(lambda: list(sub.rising(limit=SCAN_LIMIT))),
+        asyncio.to_thread(TokenBucket, POSTS_PER_RUN, POST_SPACING),
+    )
+
+    timing("listing fetched")
+
+    scanned, _ = await asyncio.to_thread(enqueue, store, hot + rising)
+
+    # read after the upsert, items still backing off keep their attempts and are left alone
+    due = await asyncio.to_thread(lambda: list(queue.find({"next_attempt": {"$lte": time.time()}}).sort("created_utc", 1)))
+
+    done = await asyncio.to_thread(store.seen, [x["_id"] for x in due])
+
+    posted = 0
+
+    try:
+        for item in due:
+            if posted >= POSTS_PER_RUN:
+                break
+
+            if item["_id"] in done:
+                await asyncio.to_thread(queue.delete_one, {"_id": item["_id"]})
                 continue
 
+            # claim it, whichever run moves next_attempt first gets to post it
+            item = await asyncio.to_thread(
+                queue.find_one_and_update,
+                {"_id": item["_id"], "next_attempt": item["next_attempt"]},
+                {"$set": {"next_attempt": time.time() + CLAIM_TTL}},
+                return_document=pymongo.ReturnDocument.BEFORE,
+            )
+
+            if not item:
+                continue
+
+            if not await asyncio.to_thread(bucket.take):
+                log.debug("Out of post tokens")
+
+                await asyncio.to_thread(queue.update_one, {"_id": item["_id"]}, {"$set": {"next_attempt": item["next_attempt"]}})
+                break
+
+            if posted:
+                await asyncio.sleep(POST_SPACING)
+
+            submission = scanned.get(item["_id"])
+
+            if not submission:
+                submission = reddit.submission(id=item["_id"])
+
+                # praw fetches on first attribute access, keep that off the loop
+                await asyncio.to_thread(getattr, submission, "title")
+
             try:
-                send(submission)
+                await send(submission)
+            except ImgurRateLimited as e:
+                # not the posts fault, try again later without counting it as an attempt
+                log.warning(f"{e}, requeueing {submission.id}")
+
+                await asyncio.gather(
+                    asyncio.to_thread(bucket.refund),
+                    asyncio.to_thread(queue.update_one, {"_id": submission.id}, {"$set": {"next_attempt": time.time() + RETRY_BACKOFF}}),
+                )
+
+                continue
+            except BlueskyUnavailable as e:
+                # nothing else will get through either, leave the queue as it was for the next run
+                log.warning(f"{e}, stopping")
+
+                await asyncio.gather(
+                    asyncio.to_thread(bucket.refund),
+                    asyncio.to_thread(queue.update_one, {"_id": submission.id}, {"$set": {"next_attempt": item["next_attempt"]}}),
+                )
+
+                break
             except:
                 log.error(f"Error posting {submission.shortlink}\n{traceback.format_exc()}")
+
+                attempts = item["attempts"] + 1
+
+                if attempts >= MAX_ATTEMPTS:
+                    log.error(f"Giving up on {submission.id} after {attempts} attempts")
+
+                    await asyncio.to_thread(store.add, submission.id)
+                    await asyncio.to_thread(queue.delete_one, {"_id": submission.id})
+
+                else:
+                    await asyncio.to_thread(queue.update_one, {"_id": submission.id}, {"$set": {
+                        "attempts": attempts,
+                        "next_attempt": time.time() + RETRY_BACKOFF * 2 ** (attempts - 1),
+                    }})
+
                 continue
 
-            db.insert_one({"id": submission.id})
+            await asyncio.gather(
+                asyncio.to_thread(store.add, submission.id),
+                asyncio.to_thread(queue.delete_one, {"_id": submission.id}),
+            )
 
-            break
+            posted += 1
+
+    finally:
+        for result in await asyncio.gather(*background, return_exceptions=True):
+            if isinstance(result, Exception):
+                log.error(f"Background task failed: {result!r}")
+
+        if http._obj:
+            await http.aclose()
+
+            http._obj = None
+            host_limits.clear()
+
+        if stats._obj:
+            await asyncio.to_thread(stats.close)
+
+            stats._obj = None
+
+        if METRICS_FILE:
+            metrics.write_textfile(METRICS_FILE)
+
+class ImgurRateLimited(Exception):
+    pass
+
+class BlueskyUnavailable(Exception):
+    pass
+
+def bluesky_unavailable(e: Exception) -> bool:
+    # outages, throttling and auth problems, none of them the posts fault
+    if isinstance(e, atproto_errors.RequestErrorBase):
+        status = e.response.status_code if e.response else None
+        return status is None or status in (401, 403, 429) or status >= 500
+
+    return isinstance(e, httpx.TransportError)
+
+def imgur_budget_ok() -> bool:
+    limits = imgur_cache.find_one({"_id": "ratelimit"})
+
+    if not limits:
+        return True
+
+    now = time.time()
+
+    if limits.get("user_remaining", IMGUR_MIN_CREDITS) < IMGUR_MIN_CREDITS and now < limits.get("user_reset", 0):
+        return False
+
+    if limits.get("client_remaining", IMGUR_MIN_CREDITS) < IMGUR_MIN_CREDITS and now < limits["updated_at"] + IMGUR_CLIENT_BACKOFF:
+        return False
+
+    return True
+
+def imgur_track_budget(response: httpx.Response) -> None:
+    h = response.headers
+
+    limits = {"updated_at": time.time()}
+
+    for key, header in (
+        ("client_remaining", "X-RateLimit-ClientRemaining"),
+        ("user_remaining", "X-RateLimit-UserRemaining"),
+        ("user_reset", "X-RateLimit-UserReset"),
+    ):
+        if h.get(header, "").isdigit():
+            limits[key] = int(h[header])
 
-def get_media_urls(url):
-    IMGUR_HEADERS = {'Authorization': 'Client-ID {}'.format(IMGUR_CLIENT_ID)}
+    if response.status_code == 429:
+        limits.setdefault("client_remaining", 0)
 
+    log.debug(f"Imgur credits: client {limits.get('client_remaining')} user {limits.get('user_remaining')}")
+
+    imgur_cache.update_one({"_id": "ratelimit"}, {"$set": limits}, upsert=True)
+
+async def imgur_get(path: str) -> dict:
+    if cached := await asyncio.to_thread(imgur_cache.find_one, {"_id": path, "fetched_at": {"$gt": time.time() - IMGUR_CACHE_TTL}}):
+        log.debug(f"Imgur cache hit {path}")
+        return cached["data"]
+
+    if not await asyncio.to_thread(imgur_budget_ok):
+        raise ImgurRateLimited(f"Imgur credits low, not resolving {path}")
+
+    async with http_stream("GET", f'https://api.imgur.com/3/{path}', headers={'Authorization': f'Client-ID {IMGUR_CLIENT_ID}'}) as response:
+        await response.aread()
+
+    await asyncio.to_thread(imgur_track_budget, response)
+
+    response.raise_for_status()
+
+    data = response.json()['data']
+
+    await asyncio.to_thread(imgur_cache.update_one, {"_id": path}, {"$set": {"data": data, "fetched_at": time.time()}}, upsert=True)
+
+    return data
+
+async def get_media_urls(url):
     url = url.replace('http:', 'https:').replace('gallery', 'a')
 
     # If its an imgur album
@@ -85,36 +492,200 @@ def get_media_urls(url):
     if match:
         album_id = match.group(3)
 
-        response = requests.get('https://api.imgur.com/3/album/{}'.format(album_id), headers=IMGUR_HEADERS)
+        data = await imgur_get('album/{}'.format(album_id))
 
-        return [s['link'] for s in response.json()['data']['images']]
+        return [s['link'] for s in data['images']]
 
     #if its an imgur image
     match = re.match(r"(?:https?\:\/\/)?(?:www\.)?(?:m\.)?(?:i\.)?imgur\.com\/([a-zA-Z0-9]+)", url)
     if match:
         image_id = match.group(1)
 
-        response = requests.get('https://api.imgur.com/3/image/{}'.format(image_id), headers=IMGUR_HEADERS)
+        data = await imgur_get('image/{}'.format(image_id))
 
-        return [response.json()['data']['link']]
+        return [data['link']]
 
     # if its a reddit hosted image
     if any(s in url for s in ('i.redd.it', 'i.reddituploads.com')):
         return [ url if re.findall(r'/([^/]+\.(?:jpg|jpeg|gif|png))', url) else '{}.jpg'.format(url) ]
 
-def fetch_media(url: str) -> bytes:
-    response = requests.get(url, stream=True, headers={'User-agent': 'Mozilla/5.0'})
-    response.raw.decode_content = True
+async def fetch_media(url: str) -> Optional[bytes]:
+    async with http_stream("GET", url, headers={'User-agent': 'Mozilla/5.0'}) as response:
+        if not response.is_success or not response.headers.get('Content-Type', '').startswith('image'):
+            return None
+
+        if int(response.headers.get('Content-Length') or 0) > MAX_FETCH_SIZE:
+            log.warning(f"Skipping {url}, {response.headers['Content-Length']} bytes is over the limit")
+            return None
+
+        chunks = []
+        size = 0
+        sniffed = False
+
+        async for chunk in response.aiter_bytes(FETCH_CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+
+            if size > MAX_FETCH_SIZE:
+                log.warning(f"Skipping {url}, body is over {MAX_FETCH_SIZE} bytes")
+                return None
+
+            if not sniffed:
+                # read the dimensions from the header, and bail before downloading the rest of something we cant use
+                try:
+                    width, height = Image.open(BytesIO(b"".join(chunks))).size
+                except Exception:
+                    # header not complete yet
+                    sniffed = size > SNIFF_SIZE
+                    continue
+
+                sniffed = True
+
+                if width * height > MAX_PIXELS:
+                    log.warning(f"Skipping {url}, {width}x{height} is too many pixels")
+                    return None
+
+    return b"".join(chunks)
+
+def flatten(im: Image.Image) -> Image.Image:
+    if im.mode == "P":
+        im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+
+    if im.mode in ("RGBA", "LA", "PA"):
+        im = im.convert("RGBA")
+
+        bg = Image.new("RGB", im.size, (255, 255, 255))
+        bg.paste(im, mask=im.getchannel("A"))
+
+        return bg
+
+    if im.mode != "RGB":
+        return im.convert("RGB")
+
+    return im
 
-    if not response.headers.get('Content-Type').startswith('image'):
+def encode_jpeg(im: Image.Image, quality: int) -> bytes:
+    fp = BytesIO()
+    with metrics.work("image_encode"):
+        im.save(fp, format='JPEG', quality=quality, optimize=True)
+
+    return fp.getvalue()
+
+def encode_image(data: bytes) -> Optional[Tuple[bytes, Tuple[int, int]]]:
+    im = Image.open(BytesIO(data))
+
+    if max(im.size) <= MAX_DIM and len(data) <= MAX_SIZE:
+        return data, im.size
+
+    # let the jpeg decoder do most of the downscale for us
+    im.draft("RGB", (MAX_DIM, MAX_DIM))
+
+    with metrics.work("image_decode"):
+        im.load()
+        src = flatten(im)
+
+    with metrics.work("image_resize"):
+        im = src.copy()
+        im.thumbnail((MAX_DIM, MAX_DIM), Image.LANCZOS, reducing_gap=3.0)
+
+    log.debug(f"Resizing image {src.size} -> {im.size}")
+
+    best = None
+    lo, hi = JPEG_QUALITY_MIN, JPEG_QUALITY_MAX
+
+    for attempt in range(MAX_ENCODE_ATTEMPTS):
+        # try the best quality first, most images fit straight away
+        quality = hi if attempt == 0 else (lo + hi) // 2
+
+        out = encode_jpeg(im, quality)
+
+        if len(out) <= MAX_SIZE:
+            best = out
+            lo = quality + 1
+        else:
+            hi = quality - 1
+
+        if attempt == 0 and best or lo > hi:
+            break
+
+    for _ in range(MAX_RESIZE_ATTEMPTS):
+        if best is not None:
+            break
+
+        # still too big at the lowest quality, scale down again from the source
+        scale = (MAX_SIZE / len(out)) ** 0.5 * 0.9
+        size = tuple(max(1, int(x * scale)) for x in im.size)
+
+        log.debug(f"Resizing image {im.size} -> {size}")
+
+        with metrics.work("image_resize"):
+            im = src.resize(size, Image.LANCZOS)
+
+        out = encode_jpeg(im, JPEG_QUALITY_MIN)
+
+        if len(out) <= MAX_SIZE:
+            best = out
+
+    if best is None:
+        log.warning(f"Image still {len(out)} bytes at {im.size}, leaving it out")
         return None
 
-    return response.raw.data
+    log.debug(f"Encoded image {im.size} at {len(best)} bytes")
+
+    return best, im.size
+
+async def prepare_image(url: str, limit: asyncio.Semaphore) -> Optional[Tuple[bytes, models.AppBskyEmbedDefs.AspectRatio]]:
+    async with limit:
+        data = await fetch_media(url)
+
+        if not data:
+            return None
 
-def send(submission: praw.reddit.Submission):
+        # cpu bound, pillow releases the gil while it works
+        if not (encoded := await asyncio.to_thread(encode_image, data)):
+            return None
+
+    data, (width, height) = encoded
+
+    return data, models.AppBskyEmbedDefs.AspectRatio(height=height, width=width)
+
+async def upload_blobs(bluesky: atproto.AsyncClient, images: List[bytes]) -> Tuple[list, List[str]]:
+    if not images:
+        return [], []
+
+    digests = [hashlib.sha256(data).hexdigest() for data in images]
+
+    cached = {
+        doc["_id"]: doc["blob"]
+        for doc in await asyncio.to_thread(lambda: list(blob_cache.find({"_id": {"$in": digests}})))
+    }
+
+    async def upload(data: bytes, digest: str):
+        if digest in cached:
+            log.debug(f"Reusing blob {digest}")
+            return models.blob_ref.BlobRef.model_validate(cached[digest])
+
+        with metrics.request("bluesky", "upload_blob"):
+            return (await bluesky.upload_blob(data)).blob
+
+    return await asyncio.gather(*[upload(d, h) for d, h in zip(images, digests)]), digests
+
+def remember_blobs(blobs: list, digests: List[str]) -> None:
+    # only once a post references them, unreferenced blobs get cleaned up by the pds
+    blob_cache.bulk_write([
+        pymongo.UpdateOne({"_id": h}, {"$set": {"blob": b.model_dump(mode="json", by_alias=True)}}, upsert=True)
+        for b, h in zip(blobs, digests)
+    ], ordered=False)
+
+async def send(submission: praw.reddit.Submission):
     images = []
     image_ratios = []
     embed = None
+    oembed = None
+    thumb = None
+
+    # log in while the media is being fetched
+    login = asyncio.create_task(get_bluesky())
 
     builder = client_utils.TextBuilder()
 
@@ -126,79 +697,81 @@ def send(submission: praw.reddit.Submission):
     for tag in BLUESKY_TAGS.split(","):
         builder.tag(f"#{tag}", f"{tag}")
 
-    if any(s in submission.url for s in ('imgur.com', 'i.redd.it', 'i.reddituploads.com')):
-        urls = get_media_urls(submission.url)
-
-        for url in urls:
-            if data := fetch_media(url):
-                fp = BytesIO(data)
-                im = Image.open(fp)
+    limit = asyncio.Semaphore(MEDIA_WORKERS)
 
-                MAX_DIM = 2000
-                MAX_SIZE = 1E6
+    try:
+        if any(s in submission.url for s in ('imgur.com', 'i.redd.it', 'i.reddituploads.com')):
+            # bluesky rejects posts with more, dont fetch what cant be used
+            urls = (await get_media_urls(submission.url))[:MAX_IMAGES]
 
-                while max(im.size) > MAX_DIM or len(data) > MAX_SIZE:
-                    if max(im.size) > MAX_DIM:
-                        ratio = MAX_DIM / max(im.size)
-                    else:
-                        ratio = 0.9
+            for result in await asyncio.gather(*[prepare_image(url, limit) for url in urls]):
+                if result:
+                    data, ratio = result
 
-                    new_size = tuple(int(x * ratio) for x in im.size)
+                    images.append(data)
+                    image_ratios.append(ratio)
 
-                    log.debug(f"Resizing image {im.size} -> {new_size}")
 
-                    im = im.resize(new_size)
+        elif m := submission.media:
+            if oembed := m.get('oembed'):
+                if result := await prepare_image(oembed['thumbnail_url'], limit):
+                    thumb, _ = result
 
-                    fp = BytesIO()
-                    im.save(fp, format='JPEG')
-                    fp.seek(0)
+        try:
+            bluesky = await login
+        except Exception as e:
+            raise BlueskyUnavailable(f"Could not log in to bluesky: {e!r}") from e
 
-                    data = fp.read()
+    except BaseException:
+        login.cancel()
+        raise
 
-                images.append(data)
-                image_ratios.append(models.AppBskyEmbedDefs.AspectRatio(height=im.height, width=im.width))
+    try:
+        blobs, digests = await upload_blobs(bluesky, images or ([thumb] if thumb else []))
+    except Exception as e:
+        if bluesky_unavailable(e):
+            raise BlueskyUnavailable(f"Could not upload to bluesky: {e!r}") from e
+        raise
 
-
-    elif m := submission.media:
-        if oembed := m.get('oembed'):
-            embed = atproto.models.AppBskyEmbedExternal.Main(
-                external=atproto.models.AppBskyEmbedExternal.External(
-                    title=oembed['title'],
-                    description=f"{oembed['provider_name']} {oembed['type']} by {oembed['author_name']}",
-                    uri=submission.url,
-                    thumb=bluesky.upload_blob(fetch_media(oembed['thumbnail_url'])).blob,
-                )
+    if images:
+        embed = models.AppBskyEmbedImages.Main(images=[
+            models.AppBskyEmbedImages.Image(alt="", image=blob, aspect_ratio=ratio)
+            for blob, ratio in zip(blobs, image_ratios)
+        ])
+
+    elif oembed:
+        embed = atproto.models.AppBskyEmbedExternal.Main(
+            external=atproto.models.AppBskyEmbedExternal.External(
+                title=oembed['title'],
+                description=f"{oembed['provider_name']} {oembed['type']} by {oembed['author_name']}",
+                uri=submission.url,
+                thumb=blobs[0] if blobs else None,
             )
+        )
 
     log.info(f'Posting: {submission.shortlink}')
 
-    if images:
-        bluesky.send_images(builder, images=images, image_aspect_ratios=image_ratios)
-    else:
-        bluesky.post(builder, embed=embed)
+    try:
+        with metrics.request("bluesky", "send_post"):
+            await bluesky.send_post(builder, embed=embed)
+    except Exception as e:
+        if bluesky_unavailable(e):
+            raise BlueskyUnavailable(f"Could not post to bluesky: {e!r}") from e
+        raise
 
+    if blobs:
+        run_in_background(asyncio.to_thread(remember_blobs, blobs, digests))
 
     bm = bluesky.me
 
-    webhook = DiscordWebhook(
-        url=STATS_WH,
-        content="",
-        username=bm.handle,
-        avatar_url=bm.avatar,
-        rate_limit_retry=True
-    )
-
-    embed = DiscordEmbed(
+    # only queued here, the sink sends it in batches from its own thread
+    stats.emit(
         title=f"Posted: {submission.title}",
         description=f"score: {submission.score} (thresh {SCORE_THRESH})\n{submission.shortlink}",
-        color="2196F3"
+        username=bm.handle,
+        avatar_url=bm.avatar,
     )
 
-    embed.set_timestamp()
-
-    webhook.add_embed(embed)
-    webhook.execute()
-
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+import requests
+
+from urllib.parse import urlparse
+
+from pymongo import monitoring
+
+from common.metrics import Metrics, service
+
+
+class MongoTimings(monitoring.CommandListener):
+    def __init__(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        self.metrics.observe("vinesauce_request_duration_seconds", event.duration_micros / 1E6, service="mongo", op=event.command_name)
+
+    def failed(self, event) -> None:
+        self.metrics.observe("vinesauce_request_duration_seconds", event.duration_micros / 1E6, service="mongo", op=event.command_name)
+        self.metrics.inc("vinesauce_request_errors_total", service="mongo", op=event.command_name)
+
+def timed_session(metrics: Metrics) -> requests.Session:
+    def track_response(response: requests.Response, *args, **kwargs) -> None:
+        host = urlparse(response.url).hostname
+        labels = {"service": service(host), "op": host}
+
+        metrics.observe("vinesauce_request_duration_seconds", response.elapsed.total_seconds(), **labels)
+
+        if response.status_code >= 400:
+            metrics.inc("vinesauce_request_errors_total", **labels)
+
+    session = requests.Session()
+    session.hooks["response"].append(track_response)
+
+    return session
@@ -0,0 +1,41 @@
+import sys
+import time
+import logging
+import importlib
+import threading
+
+
+# the bots import this before anything heavy, so the timings include their imports
+STARTED = time.perf_counter()
+
+TIMINGS = '--timings' in sys.argv
+
+
+log = logging.getLogger(__name__)
+
+
+def timing(msg: str) -> None:
+    if TIMINGS:
+        log.info(f"[timing] {msg} at {time.perf_counter() - STARTED:.3f}s")
+
+
+class Lazy(object):
+    """Stands in for an object that is only built the first time one of its attributes is used"""
+
+    def __init__(self, name, factory) -> None:
+        self._name = name
+        self._factory = factory
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self._obj = self._factory()
+                    timing(f"{self._name} ready")
+
+        return getattr(self._obj, attr)
+
+def lazy_import(name: str) -> Lazy:
+    return Lazy(name, lambda: importlib.import_module(name))
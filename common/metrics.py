@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+
+from typing import Dict, Tuple
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    "vinesauce_request_duration_seconds": ("histogram", "Time spent on calls to external services"),
+    "vinesauce_request_errors_total": ("counter", "Calls to external services that failed"),
+    "vinesauce_work_duration_seconds": ("histogram", "Time spent on local cpu heavy work"),
+}
+
+
+# hosts are grouped into the service they belong to, anything else is labelled with its host
+SERVICES = {
+    "reddit.com": "reddit",
+    "redd.it": "reddit",
+    "imgur.com": "imgur",
+    "bsky.social": "bluesky",
+    "twitch.tv": "helix",
+    "jtvnw.net": "twitch_cdn",
+    "amazonaws.com": "s3",
+    "youtube.com": "youtube",
+    "googleapis.com": "youtube",
+    "ytimg.com": "youtube",
+    "discord.com": "discord",
+}
+
+
+def service(host: str) -> str:
+    host = host or ""
+
+    for suffix, name in SERVICES.items():
+        if host == suffix or host.endswith(f".{suffix}"):
+            return name
+
+    return host
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics(object):
+    """Counters and histograms, rendered in the prometheus text format"""
+
+    def __init__(self, **const_labels) -> None:
+        self.const_labels = const_labels
+
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], list] = {}  # bucket counts, then sum and count
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            h = self._histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+
+            h[-2] += value
+            h[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+
+        try:
+            yield
+
+        except BaseException:
+            if name == "vinesauce_request_duration_seconds":
+                self.inc("vinesauce_request_errors_total", **labels)
+
+            raise
+
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def request(self, service: str, op: str):
+        return self.timer("vinesauce_request_duration_seconds", service=service, op=op)
+
+    def work(self, task: str):
+        return self.timer("vinesauce_work_duration_seconds", task=task)
+
+    def render(self) -> str:
+        def fmt(labels: tuple, **extra) -> str:
+            pairs = list(self.const_labels.items()) + list(labels) + list(extra.items())
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        seen = set()
+
+        def header(name: str) -> None:
+            if name not in seen and name in HELP:
+                kind, text = HELP[name]
+
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+            seen.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{fmt(labels)} {value}")
+
+        for (name, labels), h in histograms:
+            header(name)
+
+            for bound, count in zip(BUCKETS, h):
+                lines.append(f"{name}_bucket{fmt(labels, le=bound)} {count}")
+
+            lines.append(f'{name}_bucket{fmt(labels, le="+Inf")} {h[-1]}')
+            lines.append(f"{name}_sum{fmt(labels)} {h[-2]}")
+            lines.append(f"{name}_count{fmt(labels)} {h[-1]}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        # for the node exporter textfile collector, which must never see a half written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+
+        with open(tmp, "w") as fp:
+            fp.write(self.render())
+
+        os.replace(tmp, path)
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        server.daemon_threads = True
+
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+        return server
@@ -0,0 +1,67 @@
+import os
+import json
+import logging
+
+from typing import Iterable, Set
+
+import pymongo
+
+
+log = logging.getLogger(__name__)
+
+
+class SeenStore(object):
+    """Ids already posted, kept in mongo with an optional local file so known ids never cost a query"""
+
+    def __init__(self, collection, cache_file=None) -> None:
+        self.collection = collection
+        self.cache_file = cache_file
+        self.known: Set[str] = set()
+
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file) as fp:
+                self.known.update(json.load(fp))
+
+        try:
+            self.collection.create_index("id", unique=True)
+        except pymongo.errors.PyMongoError as e:
+            log.warning(f"Could not create unique index on id: {e}")
+
+    def seen(self, ids: Iterable[str]) -> Set[str]:
+        ids = set(ids)
+        unknown = ids - self.known
+
+        if unknown:
+            for doc in self.collection.find({"id": {"$in": list(unknown)}}, {"id": 1}):
+                self.known.add(doc["id"])
+
+            self._save()
+
+        return ids & self.known
+
+    def add_many(self, ids: Iterable[str]) -> None:
+        ids = set(ids)
+
+        if not ids:
+            return
+
+        self.collection.bulk_write(
+            [pymongo.UpdateOne({"id": _id}, {"$setOnInsert": {"id": _id}}, upsert=True) for _id in ids],
+            ordered=False
+        )
+
+        self.known.update(ids)
+        self._save()
+
+    def add(self, _id: str) -> None:
+        self.add_many([_id])
+
+    def __contains__(self, _id) -> bool:
+        return _id in self.seen([_id])
+
+    def _save(self) -> None:
+        if not self.cache_file:
+            return
+
+        with open(self.cache_file, "w") as fp:
+            json.dump(sorted(self.known), fp)
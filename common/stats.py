@@ -0,0 +1,160 @@
+import json
+import time
+import queue
+import logging
+import threading
+import urllib.error
+import urllib.request
+
+from typing import List, Optional
+from datetime import datetime as dt, timezone
+
+
+log = logging.getLogger(__name__)
+
+MAX_EMBEDS = 10  # per discord message
+MAX_TRIES = 3
+
+
+class StatsSink(object):
+    """Sends discord webhook embeds from a background thread, batched into as few messages as possible"""
+
+    def __init__(self, url: Optional[str], username: str = None, avatar_url: str = None, queue_file: str = None, window: float = 2.0) -> None:
+        self.url = url
+        self.username = username
+        self.avatar_url = avatar_url
+        self.queue_file = queue_file
+        self.window = window
+
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._save_lock = threading.Lock()
+        self._thread = None
+
+        if not url:
+            return
+
+        # pick up anything the last run didnt get to send
+        if queue_file:
+            try:
+                with open(queue_file) as fp:
+                    for line in fp:
+                        self._queue.put(json.loads(line))
+
+                open(queue_file, "w").close()
+
+            except FileNotFoundError:
+                pass
+
+        self._thread = threading.Thread(target=self._run, name="stats", daemon=True)
+        self._thread.start()
+
+    def emit(self, title: str, description: str = "", color: int = 0x2196F3, username: str = None, avatar_url: str = None) -> None:
+        if not self.url:
+            return
+
+        self._queue.put({
+            "username": username or self.username,
+            "avatar_url": avatar_url or self.avatar_url,
+            "embed": {
+                "title": title[:256],
+                "description": description[:4096],
+                "color": color,
+                "timestamp": dt.now(tz=timezone.utc).isoformat(),
+            },
+        })
+
+    def close(self, timeout: float = 5.0) -> None:
+        if not self._thread:
+            return
+
+        self._closed.set()
+        self._thread.join(timeout)
+
+        # if its still sending, take back what it hasnt picked up yet. a batch in flight is saved by the thread if it fails
+        unsent = []
+
+        while True:
+            try:
+                unsent.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self._save(unsent)
+
+    def _save(self, events: List[dict]) -> None:
+        if not events:
+            return
+
+        if not self.queue_file:
+            log.warning(f"Dropping {len(events)} unsent stats events")
+            return
+
+        log.warning(f"Saving {len(events)} unsent stats events")
+
+        with self._save_lock, open(self.queue_file, "a") as fp:
+            for event in events:
+                fp.write(json.dumps(event) + "\n")
+
+    def _run(self) -> None:
+        while not (self._closed.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + (0 if self._closed.is_set() else self.window)
+
+            while len(batch) < MAX_EMBEDS:
+                try:
+                    event = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+                # one message can only have one author, the rest goes in the next batch
+                if (event["username"], event["avatar_url"]) != (first["username"], first["avatar_url"]):
+                    self._queue.put(event)
+                    break
+
+                batch.append(event)
+
+            if not self._send(batch):
+                self._save(batch)
+
+    def _send(self, batch: List[dict]) -> bool:
+        payload = {
+            "content": "",
+            "username": batch[0]["username"],
+            "avatar_url": batch[0]["avatar_url"],
+            "embeds": [e["embed"] for e in batch],
+        }
+
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json", "User-Agent": "VinesauceReddit stats"},
+        )
+
+        for _ in range(MAX_TRIES):
+            try:
+                with urllib.request.urlopen(request, timeout=10):
+                    return True
+
+            except urllib.error.HTTPError as e:
+                if e.code != 429:
+                    log.error(f"Stats webhook failed: {e}")
+                    return False
+
+                try:
+                    retry_after = float(json.loads(e.read()).get("retry_after", 1))
+                except Exception:
+                    retry_after = float(e.headers.get("Retry-After", 1))
+
+                time.sleep(min(retry_after, 30))
+
+            except Exception as e:
+                log.error(f"Stats webhook failed: {e}")
+                return False
+
+        return False
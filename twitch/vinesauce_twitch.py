@@ -4,13 +4,17 @@ import sys
 import json
 import yaml
 import math
+import time
+import signal
 import asyncio
+import hashlib
 import logging
 
 from PIL import Image
 from io import BytesIO
 from enum import IntEnum
 from typing import Set, Dict, List, Optional
+from contextlib import suppress
 from datetime import datetime as dt, timezone
 
 import sass
@@ -18,9 +22,17 @@ import aiohttp
 import asyncpraw
 
 from twitchAPI.twitch import Twitch
+from twitchAPI.eventsub.webhook import EventSubWebhook
+from twitchAPI.object.eventsub import StreamOnlineEvent, StreamOfflineEvent, ChannelUpdateEvent
 from pydantic import BaseModel, constr
 from aiopath import AsyncPath
 
+# the image copies common/ in next to the bot, in a checkout it is one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from common.stats import StatsSink
+from common.metrics import Metrics, service
+
 
 TWITCH_CLIENT_ID = os.environ.get("TWITCH_CLIENT_ID")
 TWITCH_CLIENT_SECRET = os.environ.get("TWITCH_CLIENT_SECRET")
@@ -32,9 +44,49 @@ REDDIT_REFRESH_TOKEN = os.environ.get("REDDIT_REFRESH_TOKEN")
 SUBREDDIT = os.environ.get("SUBREDDIT")
 WIDGET_ID = os.environ.get("WIDGET_ID")
 
+STATS_WH = os.environ.get("STATS_WH")
+STATS_QUEUE = os.environ.get("STATS_QUEUE")  # optional file to keep unsent stats in between runs
+STATS_LIVE = bool(os.environ.get("STATS_LIVE"))  # opt in to a stats message for every friend going live
+
+METRICS_FILE = os.environ.get("METRICS_FILE")  # prometheus textfile written at exit
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # serves /metrics in daemon mode
+
 CACHE_DIR = AsyncPath('.cache')
 
 STREAMER_CACHE = CACHE_DIR.joinpath("streamers.json")  # AsyncPath("streamers.json")
+SPRITE_CACHE = CACHE_DIR.joinpath("sprite.json")
+SPRITE_IMAGE = CACHE_DIR.joinpath("sprite.png")  # the uploaded sprite, new avatars get pasted into it
+SLOT_CACHE = CACHE_DIR.joinpath("slots.json")  # sprite row of every login, stable between builds
+WIDGET_CACHE = CACHE_DIR.joinpath("widget.json")
+USER_CACHE = CACHE_DIR.joinpath("users.json")
+CSS_CACHE = CACHE_DIR.joinpath("widget.css.json")  # widget.scss compiled, keyed by its hash
+
+USER_TTL = int(os.environ.get("USER_TTL", 6 * 60 * 60))  # seconds before cached twitch users are refetched
+HELIX_CHUNK = 100  # max logins per helix request
+HTTP_TIMEOUT = int(os.environ.get("HTTP_TIMEOUT", 2 * 60))  # seconds for any one reddit request, the sprite upload included
+
+WIDGET_MAX_STALENESS = int(os.environ.get("WIDGET_MAX_STALENESS", 30 * 60))  # seconds before an unchanged widget is pushed anyway
+
+AVATAR_CACHE = CACHE_DIR.joinpath("avatars")
+AVATAR_INDEX = AVATAR_CACHE.joinpath("index.json")
+AVATAR_CONCURRENCY = int(os.environ.get("AVATAR_CONCURRENCY", 8))
+AVATAR_MAX_AGE = int(os.environ.get("AVATAR_MAX_AGE", 24 * 60 * 60))  # seconds before a cached avatar is revalidated
+
+THUMB_SIZE = 42
+
+SLOT_FRAGMENTATION = float(os.environ.get("SLOT_FRAGMENTATION", 0.25))  # share of free sprite rows before it is compacted
+
+# daemon mode schedule, in seconds
+UPDATE_INTERVAL = int(os.environ.get("UPDATE_INTERVAL", 60))
+CONFIG_INTERVAL = int(os.environ.get("CONFIG_INTERVAL", 60 * 60))
+SPRITE_INTERVAL = int(os.environ.get("SPRITE_INTERVAL", 24 * 60 * 60))
+
+# eventsub, pushes status changes to the daemon instead of waiting for the next poll
+EVENTSUB_CALLBACK = os.environ.get("EVENTSUB_CALLBACK")  # public https url that reaches the receiver, enables eventsub
+EVENTSUB_PORT = int(os.environ.get("EVENTSUB_PORT", 8080))
+EVENTSUB_CONCURRENCY = int(os.environ.get("EVENTSUB_CONCURRENCY", 8))
+EVENTSUB_DEBOUNCE = float(os.environ.get("EVENTSUB_DEBOUNCE", 2))  # seconds to gather a burst of events into one widget update
+RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", 15 * 60))  # full helix polling while eventsub is running, live streams are still polled every UPDATE_INTERVAL
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -43,6 +95,42 @@ ch = logging.StreamHandler()
 ch.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
 log.addHandler(ch)
 
+# the shared modules log through the same handler
+logging.getLogger("common").setLevel(logging.DEBUG)
+logging.getLogger("common").addHandler(ch)
+
+
+metrics = Metrics(bot="twitch")
+
+
+def chunked(items: list, size: int) -> List[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def trace_config() -> aiohttp.TraceConfig:
+    # times every request made through a session, whichever library owns it
+    def labels(params) -> dict:
+        return {"service": service(params.url.host), "op": params.url.host}
+
+    async def on_start(session, ctx, params):
+        ctx.started = time.perf_counter()
+
+    async def on_end(session, ctx, params):
+        metrics.observe("vinesauce_request_duration_seconds", time.perf_counter() - ctx.started, **labels(params))
+
+        if params.response.status >= 400:
+            metrics.inc("vinesauce_request_errors_total", **labels(params))
+
+    async def on_exception(session, ctx, params):
+        metrics.observe("vinesauce_request_duration_seconds", time.perf_counter() - ctx.started, **labels(params))
+        metrics.inc("vinesauce_request_errors_total", **labels(params))
+
+    tc = aiohttp.TraceConfig()
+    tc.on_request_start.append(on_start)
+    tc.on_request_end.append(on_end)
+    tc.on_request_exception.append(on_exception)
+
+    return tc
+
 
 class Config(BaseModel):
     friends: Set[constr(to_lower=True)]
@@ -92,6 +180,9 @@ class VinesauceTwitch():
     streamers: List[Streamer] = []
     subreddit: asyncpraw.reddit.Subreddit
     widget: asyncpraw.reddit.models.CustomWidget
+    eventsub: Optional[EventSubWebhook] = None
+    subscriptions: Dict[str, List[str]]
+    changed: asyncio.Event
 
     def __init__(self) -> None:
         pass
@@ -106,7 +197,8 @@ class VinesauceTwitch():
             client_id=REDDIT_CLIENT_ID,
             client_secret=REDDIT_CLIENT_SECRET,
             refresh_token=REDDIT_REFRESH_TOKEN,
-            user_agent="Vinesauce Twitch.tv monitor /u/RenegadeAI"
+            user_agent="Vinesauce Twitch.tv monitor /u/RenegadeAI",
+            requestor_kwargs={"session": aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, sock_connect=30), trace_configs=[trace_config()])},
         )  # scopes:
 
         # init target subreddit
@@ -128,7 +220,13 @@ class VinesauceTwitch():
             sys.exit(0)
 
         # init twitch
-        self.twitch = await Twitch(TWITCH_CLIENT_ID, TWITCH_CLIENT_SECRET)
+        with metrics.request("helix", "app_token"):
+            self.twitch = await Twitch(TWITCH_CLIENT_ID, TWITCH_CLIENT_SECRET)
+
+        self.stats = StatsSink(STATS_WH, queue_file=STATS_QUEUE)
+
+        self.subscriptions = {}
+        self.changed = asyncio.Event()
 
         # load config
         await self.load_config()
@@ -171,19 +269,72 @@ class VinesauceTwitch():
 
         log.debug(self.config)
 
+    async def _get_users(self, logins: List[str]) -> list:
+        # twitchAPI opens its own sessions, so these are timed here
+        with metrics.request("helix", "users"):
+            return [u async for u in self.twitch.get_users(logins=logins)]
+
+    async def _get_streams(self, logins: List[str]) -> list:
+        with metrics.request("helix", "streams"):
+            return [u async for u in self.twitch.get_streams(user_login=logins, first=HELIX_CHUNK)]
+
+    async def _load_users(self) -> Dict[str, dict]:
+        try:
+            users = json.loads(await USER_CACHE.read_text())
+        except Exception:
+            users = {}
+
+        now = dt.now(tz=timezone.utc).timestamp()
+
+        stale = [x for x in self.logins if x not in users or now - users[x]["fetched_at"] > USER_TTL]
+
+        if stale:
+            log.debug(f"Fetching {len(stale)} twitch users")
+
+            results = await asyncio.gather(*[self._get_users(c) for c in chunked(stale, HELIX_CHUNK)])
+
+            for u in (u for r in results for u in r):
+                users[u.login] = {s: getattr(u, s) for s in ["id", "login", "display_name", "profile_image_url"]}
+                users[u.login]["fetched_at"] = now
+
+            # logins twitch doesnt know, so a typo or a deleted account isnt asked for again every tick
+            for login in stale:
+                if login not in users or users[login]["fetched_at"] != now:
+                    users[login] = {"missing": True, "fetched_at": now}
+
+            await USER_CACHE.write_text(json.dumps(users))
+
+        return users
+
+    def _announce(self, s: Streamer, game_name: Optional[str], title: Optional[str]) -> None:
+        if not STATS_LIVE:
+            return
+
+        self.stats.emit(
+            title=f"Live: {s.display_name}",
+            description=f"{game_name}\n{title}\nhttps://twitch.tv/{s.login}",
+            color=0x9146FF,
+            username=s.display_name,
+            avatar_url=s.profile_image_url,
+        )
+
     async def update_streamers(self) -> None:
         data: Dict[str, dict] = {}
 
-        # fetch user data
-        async for u in self.twitch.get_users(logins=self.logins):
-            data[u.login] = {}
-            data[u.login]["status"] = StreamerStatus.OFFLINE
+        # user data
+        users = await self._load_users()
 
-            for s in ["id", "login", "display_name", "profile_image_url"]:
-                data[u.login][s] = getattr(u, s)
+        for login in self.logins:
+            if login not in users or users[login].get("missing"):
+                continue
+
+            data[login] = {k: v for k, v in users[login].items() if k != "fetched_at"}
+            data[login]["status"] = StreamerStatus.OFFLINE
 
         # fetch stream data
-        async for u in self.twitch.get_streams(user_login=self.logins):
+        results = await asyncio.gather(*[self._get_streams(c) for c in chunked(self.logins, HELIX_CHUNK)])
+
+        for u in (u for r in results for u in r):
             data[u.user_login]["status"] = StreamerStatus.LIVE
 
             for s in ["game_name", "title", "viewer_count"]:
@@ -194,6 +345,9 @@ class VinesauceTwitch():
             if not s.login in data:
                 continue
 
+            if s.status == StreamerStatus.OFFLINE and data[s.login]["status"] == StreamerStatus.LIVE:
+                self._announce(s, data[s.login].get("game_name"), data[s.login].get("title"))
+
             for k, v in data[s.login].items():
                 if k == "login":
                     continue
@@ -212,25 +366,309 @@ class VinesauceTwitch():
 
             log.debug(f"Added {s.display_name} {s.status}")
 
+        await self._save_streamers()
+
+    async def update_viewers(self) -> None:
+        # eventsub says nothing about viewers, so whoever is live is still polled for them
+        live = [s for s in self.streamers if s.status == StreamerStatus.LIVE]
+
+        if not live:
+            return
+
+        results = await asyncio.gather(*[self._get_streams(c) for c in chunked([s.login for s in live], HELIX_CHUNK)])
+        streams = {u.user_login: u for r in results for u in r}
+
+        # going offline is left to eventsub and the full poll, helix can lag behind a stream that just started
+        for s in live:
+            if u := streams.get(s.login):
+                for k in ["game_name", "title", "viewer_count"]:
+                    setattr(s, k, getattr(u, k))
+
+        await self._save_streamers()
+
+    async def _save_streamers(self) -> None:
         self.streamers.sort(key=lambda x: x.status == StreamerStatus.LIVE, reverse=True) # sort live to top
 
         await STREAMER_CACHE.write_text(json.dumps([s.model_dump() for s in self.streamers]))
 
-    def _build_css(self, img_styles: str) -> str:
-        with open("widget.scss") as fp:
-            scss = fp.read()
+    async def start_eventsub(self) -> None:
+        # the receiver runs on its own thread, the callbacks are handed back to this loop
+        eventsub = EventSubWebhook(EVENTSUB_CALLBACK, EVENTSUB_PORT, self.twitch, callback_loop=asyncio.get_running_loop())
+
+        # subscriptions outlive the process, drop whatever an earlier run left behind
+        with metrics.request("helix", "eventsub_unsubscribe"):
+            await eventsub.unsubscribe_all()
+
+        await asyncio.to_thread(eventsub.start)
+
+        self.eventsub = eventsub
+
+        log.info(f"Listening for EventSub notifications on :{EVENTSUB_PORT}")
+
+    async def _subscribe(self, sem: asyncio.Semaphore, s: Streamer) -> None:
+        topics = []
+
+        async with sem:
+            try:
+                with metrics.request("helix", "eventsub_subscribe"):
+                    topics.append(await self.eventsub.listen_stream_online(s.id, self.on_stream_online))
+                    topics.append(await self.eventsub.listen_stream_offline(s.id, self.on_stream_offline))
+                    topics.append(await self.eventsub.listen_channel_update_v2(s.id, self.on_channel_update))
+
+            except Exception as e:
+                # polling still picks them up, and the next tick tries them again from scratch
+                log.warning(f"Could not subscribe to {s.login}: {e}")
+
+                for topic in topics:
+                    with suppress(Exception):
+                        await self.eventsub.unsubscribe_topic(topic)
+
+                return
+
+        # only registered once complete, a login missing stream.offline would show live until the next reconcile
+        self.subscriptions[s.login] = topics
+
+    async def sync_subscriptions(self) -> None:
+        wanted = {s.login: s for s in self.streamers}
+
+        for login in self.subscriptions.keys() - wanted.keys():
+            log.debug(f" - unsubscribing {login}")
+
+            for topic in self.subscriptions.pop(login):
+                await self.eventsub.unsubscribe_topic(topic)
+
+        new = [s for login, s in wanted.items() if login not in self.subscriptions]
+
+        if new:
+            log.debug(f"Subscribing to {len(new)} streamers")
+
+            sem = asyncio.Semaphore(EVENTSUB_CONCURRENCY)
+            await asyncio.gather(*[self._subscribe(sem, s) for s in new])
+
+    async def _on_event(self, login: str, **changes) -> None:
+        s = next((x for x in self.streamers if x.login == login), None)
+
+        if not s:
+            return
+
+        if s.status == StreamerStatus.OFFLINE and changes.get("status") == StreamerStatus.LIVE:
+            self._announce(s, changes.get("game_name", s.game_name), changes.get("title", s.title))
+
+        for k, v in changes.items():
+            setattr(s, k, v)
+
+        log.debug(f"Event for {s.display_name} {s.status}")
+
+        await self._save_streamers()
+
+        self.changed.set()
+
+    async def on_stream_online(self, event: StreamOnlineEvent) -> None:
+        login = event.event.broadcaster_user_login
+
+        # the event only says they went live, the rest comes from helix if it has the stream yet
+        changes = {"status": StreamerStatus.LIVE, "viewer_count": 0}
+
+        try:
+            for u in await self._get_streams([login]):
+                changes.update({k: getattr(u, k) for k in ["game_name", "title", "viewer_count"]})
+
+        except Exception as e:
+            log.warning(f"Could not fetch the stream of {login}: {e}")
+
+        await self._on_event(login, **changes)
+
+    async def on_stream_offline(self, event: StreamOfflineEvent) -> None:
+        await self._on_event(event.event.broadcaster_user_login, status=StreamerStatus.OFFLINE)
+
+    async def on_channel_update(self, event: ChannelUpdateEvent) -> None:
+        await self._on_event(event.event.broadcaster_user_login, game_name=event.event.category_name, title=event.event.title)
+
+    async def _static_css(self) -> str:
+        scss = await AsyncPath("widget.scss").read_text()
+        scss_hash = hashlib.sha256(scss.encode()).hexdigest()
+
+        try:
+            cached = json.loads(await CSS_CACHE.read_text())
+        except Exception:
+            cached = {}
+
+        if cached.get("hash") == scss_hash:
+            return cached["css"]
+
+        log.debug(" - compiling widget.scss")
+
+        def compile() -> str:
+            with metrics.work("sass_compile"):
+                return sass.compile(string=scss, output_style='compressed')
+
+        loop = asyncio.get_running_loop()
+        css = await loop.run_in_executor(None, compile)
+
+        await CSS_CACHE.write_text(json.dumps({"hash": scss_hash, "css": css}))
+
+        return css
+
+    def _streamer_css(self, slots: List[Optional[dict]]) -> str:
+        # what sass would compile these to, without going through sass
+        return "".join(
+            f'li a[href*="{x["login"]}"] del:before{{background-position:0 -{i * THUMB_SIZE}px}}'
+            for i, x in enumerate(slots) if x
+        )
+
+    async def _build_css(self, slots: List[Optional[dict]]) -> str:
+        return await self._static_css() + self._streamer_css(slots)
+
+    async def _load_slots(self) -> List[Optional[dict]]:
+        try:
+            return json.loads(await SLOT_CACHE.read_text())
+        except Exception:
+            return []
+
+    def _allocate_slots(self, previous: List[Optional[dict]]) -> List[Optional[dict]]:
+        wanted = {s.login: s.profile_image_url for s in self.streamers}
+
+        # everyone keeps their row, whoever left frees theirs
+        slots = [{"login": x["login"], "url": wanted[x["login"]]} if x and x["login"] in wanted else None for x in previous]
+
+        placed = {x["login"] for x in slots if x}
+        free = [i for i, x in enumerate(slots) if x is None]
+
+        # rows that would still be empty once the newcomers are in
+        spare = len(free) - len(wanted.keys() - placed)
+
+        if slots and spare / len(slots) > SLOT_FRAGMENTATION:
+            log.debug(" - compacting sprite slots")
+
+            slots = [x for x in slots if x]
+            free = []
+
+        free.reverse()
+
+        for s in sorted(self.streamers, key=lambda x: int(x.id)):
+            if s.login in placed:
+                continue
+
+            slot = {"login": s.login, "url": s.profile_image_url}
+
+            if free:
+                slots[free.pop()] = slot
+            else:
+                slots.append(slot)
+
+        return slots
+
+    def _sprite_hash(self, sprite: Image.Image) -> str:
+        return hashlib.sha256(f"{sprite.size}".encode() + sprite.tobytes()).hexdigest()
+
+    async def _fetch_avatar(self, session: aiohttp.ClientSession, sem: asyncio.Semaphore, index: dict, url: str) -> Image.Image:
+        key = hashlib.sha256(f"{url}@{THUMB_SIZE}".encode()).hexdigest()
+        path = AVATAR_CACHE.joinpath(f"{key}.png")
+
+        entry = index.get(url)
+        now = dt.now(tz=timezone.utc).timestamp()
+
+        if entry and not await path.exists():
+            entry = None
+
+        # fresh enough, dont even ask
+        if entry and now - entry.get("fetched_at", 0) < AVATAR_MAX_AGE:
+            return Image.open(BytesIO(await path.read_bytes()))
+
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        async with sem:
+            async with session.get(url, headers=headers) as r:
+                if r.status == 304 and entry:
+                    log.debug(f" - avatar not modified {url}")
+
+                    entry["fetched_at"] = now
+                    return Image.open(BytesIO(await path.read_bytes()))
+
+                r.raise_for_status()
+
+                body = await r.read()
+
+                index[url] = {
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "fetched_at": now,
+                }
+
+        log.debug(f" - fetched avatar {url}")
 
-            scss += img_styles
+        with metrics.work("avatar_resize"):
+            im = Image.open(BytesIO(body)).convert("RGBA").resize((THUMB_SIZE, THUMB_SIZE))
 
-            css = f"// Compiled at {dt.utcnow()}\n"
-            css += sass.compile(string=scss, output_style='compressed')
+            fp = BytesIO()
+            im.save(fp, format="PNG")
 
-            return css
+        await path.write_bytes(fp.getvalue())
+
+        return im
+
+    async def _fetch_avatars(self, urls: List[str]) -> List[Image.Image]:
+        await AVATAR_CACHE.mkdir(parents=True, exist_ok=True)
+
+        try:
+            index = json.loads(await AVATAR_INDEX.read_text())
+        except Exception:
+            index = {}
+
+        sem = asyncio.Semaphore(AVATAR_CONCURRENCY)
+
+        async with aiohttp.ClientSession(trace_configs=[trace_config()]) as s:
+            avatars = await asyncio.gather(*[self._fetch_avatar(s, sem, index, url) for url in urls])
+
+        await AVATAR_INDEX.write_text(json.dumps(index))
+
+        return avatars
+
+    def _encode_sprite(self, sprite: Image.Image) -> bytes:
+        image = BytesIO()
+
+        with metrics.work("sprite_encode"):
+            sprite.save(image, format="PNG")
+
+        return image.getvalue()
+
+    async def _upload_sprite(self, png: bytes) -> str:
+        # upload the image directly, asyncpraw doesnt directly support this
+        # https://github.com/praw-dev/asyncpraw/blob/7bc8c10dd2c18229c14d1858bb1221ed806a4c00/asyncpraw/models/reddit/widgets.py#L1863
+        image = BytesIO(png)
+
+        img_data = {
+            "filepath": "sprite.png",
+            "mimetype": "image/png",
+            "file": image,
+        }
+
+        url = asyncpraw.const.API_PATH["widget_lease"].format(subreddit=self.widget.subreddit)
+        response = await self.reddit.post(url, data=img_data)
+        upload_lease = response["s3UploadLease"]
+        upload_data = {item["name"]: item["value"] for item in upload_lease["fields"]}
+        upload_url = f"https:{upload_lease['action']}"
+
+        upload_data["file"] = image
+        response = await self.reddit._core._requestor._http.post(
+            upload_url, data=upload_data
+        )
+
+        response.raise_for_status()
+
+        return f"{upload_url}/{upload_data['key']}"
 
     async def build_widget(self, update_sprite=False, update_css=False, update_height=False) -> None:
-        THUMB_SIZE = 42
+        previous = await self._load_slots()
+        slots = self._allocate_slots(previous)
 
-        streamers = sorted(self.streamers, key=lambda x: int(x.id))
+        # rows that need a new avatar pasted in, freed rows are left as they are until reused
+        changed = [i for i, x in enumerate(slots) if x and (i >= len(previous) or previous[i] != x)]
 
         try:
             current_sprite = next(x for x in self.widget.imageData if x.name == "sprite")
@@ -238,129 +676,136 @@ class VinesauceTwitch():
             current_sprite = None #asyncpraw.reddit.models.ImageData(self.reddit, {"height": -1})
 
         to_update = {}
+        new_sprite = None
 
-        if not current_sprite or current_sprite.height != len(streamers) * THUMB_SIZE:
+        # a forced update redraws every row, otherwise only the changed ones are pasted into the last sprite
+        redraw = update_sprite
+
+        if not current_sprite or current_sprite.height != len(slots) * THUMB_SIZE:
+            update_sprite = True
+            update_css = True
+
+        if changed:
             update_sprite = True
+
+        if slots != previous:
             update_css = True
-            update_height = True
 
 
         if update_sprite:
             log.debug(f"Updating sprite")
 
-            sprite = Image.new("RGBA", (THUMB_SIZE, len(self.streamers) * THUMB_SIZE))
+            try:
+                uploaded = json.loads(await SPRITE_CACHE.read_text())
+            except Exception:
+                uploaded = {}
 
-            async with aiohttp.ClientSession() as s:
-                for i, stream in enumerate(streamers):
-                    async with s.get(stream.profile_image_url) as r:
-                        fp = BytesIO()
+            base = None
 
-                        async for chunk in r.content.iter_chunked(2 * 1024):
-                            fp.write(chunk)
+            if not redraw and current_sprite and uploaded.get("url") == current_sprite.url and await SPRITE_IMAGE.exists():
+                base = Image.open(BytesIO(await SPRITE_IMAGE.read_bytes())).convert("RGBA")
 
-                        fp.seek(0)
+                if self._sprite_hash(base) != uploaded.get("hash"):
+                    base = None
 
-                        im = Image.open(fp).resize((THUMB_SIZE, THUMB_SIZE))
+            rows = changed if base else [i for i, x in enumerate(slots) if x]
 
-                        pos = i * THUMB_SIZE
+            log.debug(f" - drawing {len(rows)} of {len(slots)} rows")
 
-                        sprite.paste(im, (0, pos))
+            avatars = await self._fetch_avatars([slots[i]["url"] for i in rows])
 
+            with metrics.work("sprite_build"):
+                sprite = Image.new("RGBA", (THUMB_SIZE, len(slots) * THUMB_SIZE))
 
-            # upload the image directly, asyncpraw doesnt directly support this
-            # https://github.com/praw-dev/asyncpraw/blob/7bc8c10dd2c18229c14d1858bb1221ed806a4c00/asyncpraw/models/reddit/widgets.py#L1863
-            image = BytesIO()
-            sprite.save(image, format="PNG")
-            image.seek(0)
+                if base:
+                    sprite.paste(base.crop((0, 0, THUMB_SIZE, min(base.height, sprite.height))), (0, 0))
 
-            img_data = {
-                "filepath": "sprite.png",
-                "mimetype": "image/png",
-                "file": image,
-            }
+                for i, im in zip(rows, avatars):
+                    sprite.paste(im, (0, i * THUMB_SIZE))
 
-            url = asyncpraw.const.API_PATH["widget_lease"].format(subreddit=self.widget.subreddit)
-            response = await self.reddit.post(url, data=img_data)
-            upload_lease = response["s3UploadLease"]
-            upload_data = {item["name"]: item["value"] for item in upload_lease["fields"]}
-            upload_url = f"https:{upload_lease['action']}"
+            sprite_hash = self._sprite_hash(sprite)
 
-            upload_data["file"] = image
-            response = await self.reddit._core._requestor._http.post(
-                upload_url, data=upload_data
-            )
+            if current_sprite and uploaded.get("hash") == sprite_hash and uploaded.get("url") == current_sprite.url:
+                log.debug(" - sprite unchanged, skipping upload")
 
-            response.raise_for_status()
+                if not base:
+                    await SPRITE_IMAGE.write_bytes(self._encode_sprite(sprite))
 
-            image_url = f"{upload_url}/{upload_data['key']}"
+            else:
+                png = self._encode_sprite(sprite)
+                image_url = await self._upload_sprite(png)
 
-            if current_sprite and sprite.height == current_sprite.height:
-                # if the images are the same height, and I dont clear the widget first, uploading a new sprite will 404 for some reason
-                log.debug(" - clearing sprite")
+                if current_sprite and sprite.height == current_sprite.height:
+                    # if the images are the same height, and I dont clear the widget first, uploading a new sprite will 404 for some reason
+                    log.debug(" - clearing sprite")
 
-                to_update["css"] = self.widget.css
-                self.widget = await self.widget.mod.update(imageData=[], css='{}')
+                    to_update["css"] = self.widget.css
+                    self.widget = await self.widget.mod.update(imageData=[], css='{}')
 
-                await asyncio.sleep(1)
+                    await asyncio.sleep(1)
 
-            image_data = self.widget.imageData
+                image_data = self.widget.imageData
 
-            try:
-                image_data.remove(current_sprite)
-            except:
-                pass
+                try:
+                    image_data.remove(current_sprite)
+                except:
+                    pass
 
-            # update the widget
-            image_data.append({
-                'name': "sprite",
-                'width': sprite.width,
-                'height': sprite.height,
-                'url': image_url,
-            })
+                # update the widget
+                image_data.append({
+                    'name': "sprite",
+                    'width': sprite.width,
+                    'height': sprite.height,
+                    'url': image_url,
+                })
 
-            to_update["imageData"] = image_data
+                to_update["imageData"] = image_data
 
+                new_sprite = (sprite_hash, png)
 
         if update_css:
             log.debug("Updating CSS")
 
-            img_styles = "li {\n"
+            css = await self._build_css(slots)
 
-            for i, stream in enumerate(streamers):
-                pos = i * THUMB_SIZE
+            if css != self.widget.css:
+                to_update["css"] = css
+            else:
+                log.debug(" - css unchanged")
 
-                img_styles += f'a[href*="{stream.login}"] del:before {{ background-position: 0 -{pos}px }}\n'
 
-            img_styles += "}\n"
+        top_height = 184
+        row_height = 78
 
-            loop = asyncio.get_running_loop()
-            to_update["css"] = await loop.run_in_executor(None, self._build_css, img_styles)
+        max_height = top_height + row_height * 3 + 31
 
+        height = min(top_height + math.ceil(len(self.streamers) / 4) * row_height, max_height)
 
-        if update_height:
+        if update_height or height != self.widget.height:
             log.debug("Updating height")
 
-            top_height = 184
-            row_height = 78
-
-            max_height = top_height + row_height * 3 + 31
-
-            height = top_height + math.ceil(len(self.streamers) / 4) * row_height
-
-            if height > max_height:
-                height = max_height
-
             to_update["height"] = height
 
 
         if to_update:
             self.widget = await self.widget.mod.update(**to_update)
 
+            if new_sprite:
+                sprite_hash, png = new_sprite
+
+                # remember what reddit ended up serving, so an unchanged sprite is never uploaded again
+                url = next(x.url for x in self.widget.imageData if x.name == "sprite")
+                await SPRITE_CACHE.write_text(json.dumps({"hash": sprite_hash, "url": url}))
+                await SPRITE_IMAGE.write_bytes(png)
+
             log.info("built widget")
 
         else:
             log.info("widget build skipped")
 
+        if slots != previous:
+            await SLOT_CACHE.write_text(json.dumps(slots))
+
 
     async def update_widget(self) -> None:
         content = ""
@@ -385,10 +830,23 @@ class VinesauceTwitch():
 
         now = dt.now(tz=timezone.utc)
 
+        fingerprint = hashlib.sha256(content.encode()).hexdigest()
+
+        try:
+            published = json.loads(await WIDGET_CACHE.read_text())
+        except Exception:
+            published = {}
+
+        if published.get("hash") == fingerprint and now.timestamp() - published.get("published_at", 0) < WIDGET_MAX_STALENESS:
+            log.info('widget unchanged, update skipped')
+            return
+
         content += f'\n\n`LAST UPDATED @ {now.strftime("%X")} {now.strftime("%x")} UTC`'
 
         self.widget = await self.widget.mod.update(text=content)
 
+        await WIDGET_CACHE.write_text(json.dumps({"hash": fingerprint, "published_at": now.timestamp()}))
+
         log.info('updated widget')
 
     async def run(self) -> None:
@@ -398,8 +856,96 @@ class VinesauceTwitch():
 
         await self.update_widget()
 
+    async def refresh_config(self) -> None:
+        await self.load_config(force_fetch=True)
+
+        # drop anyone who is no longer a friend
+        self.streamers = [s for s in self.streamers if s.login in self.logins]
+
+        await self.update_streamers()
+        await self.build_widget()
+
+    async def daemon(self) -> None:
+        stop = asyncio.Event()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+            log.info(f"Serving metrics on :{METRICS_PORT}/metrics")
+
+        if EVENTSUB_CALLBACK:
+            await self.start_eventsub()
+
+        # with eventsub running, the full poll only has to catch whatever it missed
+        poll_interval = RECONCILE_INTERVAL if self.eventsub else UPDATE_INTERVAL
+
+        log.info(f"Running as daemon, polling every {poll_interval}s")
+
+        now = loop.time()
+        next_config = now + CONFIG_INTERVAL
+        next_sprite = now + SPRITE_INTERVAL
+        next_poll = now + poll_interval
+        next_viewers = now + UPDATE_INTERVAL
+
+        await self.update_streamers()
+        await self.build_widget()
+
+        while not stop.is_set():
+            started = loop.time()
+
+            self.changed.clear()
+
+            try:
+                if started >= next_config:
+                    await self.refresh_config()
+                    next_config = started + CONFIG_INTERVAL
+
+                if started >= next_sprite:
+                    await self.build_widget(update_sprite=True)
+                    next_sprite = started + SPRITE_INTERVAL
+
+                if started >= next_poll:
+                    await self.update_streamers()
+                    next_poll = started + poll_interval
+                    next_viewers = started + UPDATE_INTERVAL
+
+                elif started >= next_viewers:
+                    await self.update_viewers()
+                    next_viewers = started + UPDATE_INTERVAL
+
+                if self.eventsub:
+                    await self.sync_subscriptions()
+
+                await self.update_widget()
+
+            except Exception as e:
+                log.exception(f"Update failed: {e}")
+
+            log.debug(f"Tick took {loop.time() - started:.2f}s")
+
+            # sleep until something is due, an event arrives or we are told to stop
+            waiters = [asyncio.create_task(stop.wait()), asyncio.create_task(self.changed.wait())]
+
+            await asyncio.wait(waiters, timeout=max(0, min(next_config, next_sprite, next_poll, next_viewers) - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+
+            for w in waiters:
+                w.cancel()
+
+            if self.changed.is_set() and not stop.is_set():
+                await asyncio.sleep(EVENTSUB_DEBOUNCE)
+
+        log.info("Shutting down")
+
     async def close(self) -> None:
+        if self.eventsub:
+            # also removes our subscriptions
+            await self.eventsub.stop()
+
         await self.reddit.close()
+        await asyncio.to_thread(self.stats.close)
 
 
 async def main():
@@ -415,19 +961,23 @@ async def main():
             await bot.run()
 
         elif mode == "config":
-            await bot.load_config(force_fetch=True)
-            await bot.update_streamers()
-            await bot.build_widget()
+            await bot.refresh_config()
 
         elif mode == "sprite":
             await bot.build_widget(update_sprite=True)
 
+        elif mode == "daemon":
+            await bot.daemon()
+
     except KeyboardInterrupt:
         pass
 
     finally:
         await bot.close()
 
+        if METRICS_FILE:
+            metrics.write_textfile(METRICS_FILE)
+
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
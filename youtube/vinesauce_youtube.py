@@ -1,21 +1,39 @@
 import os
 import sys
+
+# the images copy common/ in next to the bot, in a checkout it is one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from common.lazy import Lazy, timing
+
+import time
+import hmac
+import hashlib
 import logging
 import datetime
+import threading
 import traceback
 
-from typing import List, Optional
+from typing import List, Optional, Tuple
+from functools import cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 from datetime import datetime as dt, timedelta
+from urllib.parse import parse_qs, urlparse
+from xml.etree import ElementTree
 import praw
-import prawcore
 import pymongo
 
-from apiclient.discovery import build
-from apiclient.errors import HttpError
+from googleapiclient.errors import HttpError
 from pydantic import BaseModel
 
+from common.seen import SeenStore
+from common.stats import StatsSink
+from common.metrics import Metrics
+from common.instrument import MongoTimings, timed_session
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
@@ -23,9 +41,14 @@ ch = logging.StreamHandler()
 ch.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
 log.addHandler(ch)
 
+# the shared modules log through the same handler
+logging.getLogger("common").setLevel(logging.DEBUG)
+logging.getLogger("common").addHandler(ch)
+
 
 DRY_RUN = '--dry-run' in sys.argv
 POPULATE_SEEN = '--populate-seen' in sys.argv
+WEBSUB = '--websub' in sys.argv
 
 MONGO_URI = os.environ.get("MONGO_URI")
 
@@ -37,6 +60,47 @@ DEVELOPER_KEY = os.environ.get("DEVELOPER_KEY")
 SUBREDDIT = os.environ.get("SUBREDDIT")
 FLAIR_ID = os.environ.get("FLAIR_ID")
 
+SEEN_CACHE = os.environ.get("SEEN_CACHE")  # optional file of ids known to be seen, saves asking mongo
+
+STATS_WH = os.environ.get("STATS_WH")
+STATS_QUEUE = os.environ.get("STATS_QUEUE")  # optional file to keep unsent stats in between runs
+STATS_POSTS = bool(os.environ.get("STATS_POSTS"))  # opt in to a stats message for every video posted
+
+METRICS_FILE = os.environ.get("METRICS_FILE")  # prometheus textfile written at exit
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # serves /metrics in websub mode
+
+POLL_WORKERS = int(os.environ.get("POLL_WORKERS", 4))
+
+DISCOVERY = os.environ.get("DISCOVERY", "rss")  # rss, or api to poll activities.list
+FEED_URL = os.environ.get("FEED_URL", "https://www.youtube.com/feeds/videos.xml?channel_id={}")
+FEED_TIMEOUT = (5, 30)  # connect, read
+
+SUBMIT_RETRIES = 5
+VIDEOS_PER_CALL = 50  # ids videos.list takes at once
+STICKY_SLOTS = 6  # 2 stickies plus up to 4 more community highlights
+
+WEBSUB_HUB = os.environ.get("WEBSUB_HUB", "https://pubsubhubbub.appspot.com/subscribe")
+WEBSUB_CALLBACK = os.environ.get("WEBSUB_CALLBACK")  # public url that reaches the receiver
+WEBSUB_SECRET = os.environ.get("WEBSUB_SECRET")
+WEBSUB_PORT = int(os.environ.get("WEBSUB_PORT", 8080))
+WEBSUB_LEASE = 5 * 24 * 60 * 60
+
+ATOM_NS = {
+    "atom": "http://www.w3.org/2005/Atom",
+    "yt": "http://www.youtube.com/xml/schemas/2015",
+}
+
+QUOTA_DAILY = int(os.environ.get("QUOTA_DAILY", 10000))
+QUOTA_COSTS = {
+    "activities.list": 1,
+    "videos.list": 1,
+}
+
+try:
+    QUOTA_TZ = ZoneInfo("America/Los_Angeles")  # youtube quota resets at midnight pacific
+except ZoneInfoNotFoundError:
+    QUOTA_TZ = datetime.UTC
+
 CHANNELS = [
     # {
     #     'id': 'UCzVu0rUV7xoerfGNx37SCjw',
@@ -101,8 +165,19 @@ CHANNELS = [
     # }
 ]
 
-mongo = pymongo.MongoClient(MONGO_URI)
-db = mongo.vinesauce.youtube
+
+
+metrics = Metrics(bot="youtube")
+
+
+mongo = Lazy("mongo", lambda: pymongo.MongoClient(MONGO_URI, event_listeners=[MongoTimings(metrics)]))
+db = Lazy("db", lambda: mongo.vinesauce.youtube)
+quota = Lazy("quota", lambda: mongo.vinesauce.youtube_quota)
+feeds = Lazy("feeds", lambda: mongo.vinesauce.youtube_feeds)
+
+stats = Lazy("stats", lambda: StatsSink(STATS_WH, username="YouTube", queue_file=STATS_QUEUE))
+
+feed_http = timed_session(metrics)
 
 class WatchedChannel(BaseModel):
     id: str
@@ -114,6 +189,7 @@ class Video(BaseModel):
     id: str
     title: str
     channel_title: str
+    channel_id: Optional[str] = ""
 
     @property
     def url(self):
@@ -127,68 +203,375 @@ class Video(BaseModel):
             channel_title = data["snippet"]["channelTitle"] if "channelTitle" in data["snippet"] else ""
         )
 
+    @classmethod
+    def from_feed(cls, entry):
+        return cls(
+            id = entry.findtext("yt:videoId", namespaces=ATOM_NS),
+            title = entry.findtext("atom:title", namespaces=ATOM_NS),
+            channel_title = entry.findtext("atom:author/atom:name", default="", namespaces=ATOM_NS),
+            channel_id = entry.findtext("yt:channelId", default="", namespaces=ATOM_NS)
+        )
+
+
+def make_reddit() -> praw.Reddit:
+    r = praw.Reddit(
+        client_id=REDDIT_CLIENT_ID,
+        client_secret=REDDIT_CLIENT_SECRET,
+        refresh_token=REDDIT_REFRESH_TOKEN,
+        user_agent='Vinesauce YouTube Bot - /u/RenegadeAI',
+        requestor_kwargs={"session": timed_session(metrics)},
+    )
+    r.validate_on_submit = True
+
+    return r
+
+def make_youtube():
+    # discovery is slow to import and parse, only pay for it when the api is actually used
+    from googleapiclient.discovery import build
+
+    # use the discovery document bundled with the client instead of fetching it
+    return build('youtube', 'v3', developerKey = DEVELOPER_KEY, static_discovery = True, cache_discovery = False)
+
+
+class QuotaExceeded(Exception):
+    pass
 
-class SeenVideos(object):
+
+class QuotaTracker(object):
     def __init__(self) -> None:
-        pass
+        now = dt.now(QUOTA_TZ)
+
+        self.day = now.strftime("%Y-%m-%d")
+        self.seconds_left = (now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1) - now).total_seconds()
+
+    def spend(self, method: str) -> None:
+        quota.update_one(
+            {"_id": self.day},
+            {"$inc": {"used": QUOTA_COSTS[method], f"calls.{method.replace('.', '_')}": 1}},
+            upsert=True
+        )
+
+    def exhausted(self) -> None:
+        quota.update_one({"_id": self.day}, {"$max": {"used": QUOTA_DAILY}}, upsert=True)
 
-    def __contains__(self, _id) -> bool:
-        return db.find_one({"id": _id}) is not None
+    def should_poll(self, cost: int) -> bool:
+        doc = quota.find_one({"_id": self.day}) or {}
 
-    def add(self, _id) -> None:
-        db.insert_one({"id": _id})
+        remaining = QUOTA_DAILY - doc.get("used", 0)
 
+        if remaining < cost:
+            log.warning(f"Only {remaining} quota units left today, not polling")
+            return False
+
+        # spread what is left evenly over the rest of the day
+        interval = self.seconds_left / (remaining // cost)
+        since = time.time() - doc.get("last_poll", 0)
+
+        log.debug(f"Quota: {doc.get('used', 0)}/{QUOTA_DAILY} used, polling every {interval:.0f}s")
+
+        if since < interval:
+            log.info(f"Last polled {since:.0f}s ago, next poll in {interval - since:.0f}s")
+            return False
 
-reddit = praw.Reddit(
-    client_id=REDDIT_CLIENT_ID,
-    client_secret=REDDIT_CLIENT_SECRET,
-    refresh_token=REDDIT_REFRESH_TOKEN,
-    user_agent='Vinesauce YouTube Bot - /u/RenegadeAI',
-)
-reddit.validate_on_submit = True
-subreddit = reddit.subreddit(SUBREDDIT)
-youtube = build('youtube', 'v3', developerKey = DEVELOPER_KEY)
+        quota.update_one({"_id": self.day}, {"$set": {"last_poll": time.time()}}, upsert=True)
+
+        return True
+
+
+reddit = Lazy("reddit", make_reddit)
+subreddit = Lazy("subreddit", lambda: reddit.subreddit(SUBREDDIT))
+youtube = Lazy("youtube", make_youtube)
 
 
 def main():
-    log.info(f'Logged into reddit as /u/{reddit.user.me()} on /r/{subreddit.display_name}')
-    seen = SeenVideos()
+    timing("main started")
+
+    if WEBSUB:
+        return serve_websub()
+
+    tracker = QuotaTracker()
+    channels = [WatchedChannel(**c) for c in CHANNELS]
+
+    # etag and last-modified of every feed read, only kept once what was new in it is done with
+    validators = {}
+
+    if DISCOVERY == "api":
+        if not tracker.should_poll(len(channels) * QUOTA_COSTS["activities.list"]):
+            return
+
+        discover = get_videos
+    else:
+        discover = lambda c, t: get_feed_videos(c, t, validators)
+
+    store = SeenStore(db, SEEN_CACHE)
+
+    try:
+        with ThreadPoolExecutor(max_workers=POLL_WORKERS) as pool:
+            results = list(pool.map(lambda c: discover(c, tracker), channels))
+
+    except QuotaExceeded:
+        log.critical('YouTube API quota exceeded, exiting')
+        tracker.exhausted()
+        sys.exit(1)
+
+    pending = handle([(v, channel) for channel, videos in zip(channels, results) for v in videos or []], store)
+
+    unseen = pending
+
+    if pending and DISCOVERY != "api":
+        pending = enrich(pending, tracker)
+
+    try:
+        done = set(publish(pending, store))
+
+        # a feed that still has something unposted is read again in full, a 304 would hide it
+        if not DRY_RUN:
+            for channel_id, (etag, last_modified) in validators.items():
+                if all(v.id in done for v, c in unseen if c.id == channel_id):
+                    save_validators(channel_id, etag, last_modified)
+    finally:
+        if stats._obj:
+            stats.close()
+
+def handle(found: List[Tuple[Video, WatchedChannel]], store: SeenStore) -> List[Tuple[Video, WatchedChannel]]:
+    # one lookup for the videos of every channel
+    seen = store.seen(v.id for v, _ in found)
+    unseen = []
+
+    for video, channel in found:
+        log.debug(f"  - [{channel.name}] {video.title}")
+        if video.id in seen:
+            log.debug(f"    - SEEN")
+
+            continue
+
+        unseen.append((video, channel))
+
+    return unseen
+
+def publish(pending: List[Tuple[Video, WatchedChannel]], store: SeenStore) -> List[str]:
+    if POPULATE_SEEN:
+        for video, _ in pending:
+            log.info(f'POPULATING SEEN - {video.id}')
+
+        done = [v.id for v, _ in pending]
+    else:
+        done = post(pending)
+
+    # anything that could not be submitted stays unseen and is tried again next run
+    if not DRY_RUN:
+        store.add_many(done)
+
+    return done
+
+def parse_feed(xml: bytes) -> List[Video]:
+    yesterday = dt.now(datetime.UTC) - timedelta(hours = 24)
+
+    videos = []
+
+    for entry in ElementTree.fromstring(xml).iterfind("atom:entry", ATOM_NS):
+        published = entry.findtext("atom:published", namespaces=ATOM_NS)
+
+        if published and dt.fromisoformat(published) < yesterday:
+            continue
+
+        videos.append(Video.from_feed(entry))
+
+    return videos
+
+def get_feed_videos(channel: WatchedChannel, tracker: QuotaTracker, validators: dict) -> List[Video]:
+    state = feeds.find_one({"_id": channel.id}) or {}
+
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    try:
+        r = feed_http.get(FEED_URL.format(channel.id), headers=headers, timeout=FEED_TIMEOUT)
+
+        if r.status_code == 304:
+            log.debug(f'  {channel.name} feed not modified')
+            return []
+
+        r.raise_for_status()
+
+        videos = parse_feed(r.content)
 
-    for c in CHANNELS:
-        channel = WatchedChannel(**c)
-        log.debug(f'Checking: {channel.name}')
+    except Exception as e:
+        log.warning(f'Error reading feed for {channel.name}, falling back to the API: {e}')
+        return get_videos(channel, tracker)
+
+    validators[channel.id] = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+
+    return videos
+
+def save_validators(channel_id: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+    feeds.update_one(
+        {"_id": channel_id},
+        {"$set": {"etag": etag, "last_modified": last_modified}},
+        upsert=True
+    )
+
+def enrich(pending: List[Tuple[Video, WatchedChannel]], tracker: QuotaTracker) -> List[Tuple[Video, WatchedChannel]]:
+    # confirm new feed entries from every channel against the api at once, drops anything private or deleted since
+    enriched = []
+
+    for i in range(0, len(pending), VIDEOS_PER_CALL):
+        batch = pending[i:i + VIDEOS_PER_CALL]
+
+        try:
+            request = youtube.videos().list(id = ",".join(v.id for v, _ in batch), part = "snippet")
+
+            tracker.spend("videos.list")
+
+            with metrics.request("youtube", "videos.list"):
+                r = request.execute(http = thread_http())
+
+        except Exception as e:
+            log.warning(f'Could not confirm {len(batch)} videos with the API, using the feed: {e}')
+            enriched += batch
+            continue
+
+        confirmed = {x["id"]: x["snippet"] for x in r.get("items", [])}
+
+        enriched += [
+            (v.model_copy(update={"title": confirmed[v.id]["title"], "channel_title": confirmed[v.id].get("channelTitle", v.channel_title)}), channel)
+            for v, channel in batch if v.id in confirmed
+        ]
+
+    return enriched
+
+def websub_subscribe(channels: List[WatchedChannel]) -> None:
+    while True:
+        for channel in channels:
+            data = {
+                "hub.callback": WEBSUB_CALLBACK,
+                "hub.topic": FEED_URL.format(channel.id),
+                "hub.mode": "subscribe",
+                "hub.lease_seconds": WEBSUB_LEASE,
+            }
+
+            if WEBSUB_SECRET:
+                data["hub.secret"] = WEBSUB_SECRET
+
+            try:
+                feed_http.post(WEBSUB_HUB, data=data, timeout=FEED_TIMEOUT).raise_for_status()
+                log.info(f'Subscribed to {channel.name}')
+
+            except Exception as e:
+                log.error(f'Error subscribing to {channel.name}: {e}')
+
+        # renew well before the lease runs out
+        time.sleep(WEBSUB_LEASE * 0.8)
+
+def serve_websub() -> None:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    channels = {c["id"]: WatchedChannel(**c) for c in CHANNELS}
+    topics = {FEED_URL.format(c) for c in channels}
+
+    store = SeenStore(db, SEEN_CACHE)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # the hub verifying a (un)subscription
+            query = parse_qs(urlparse(self.path).query)
+
+            if query.get("hub.topic", [""])[0] not in topics:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            challenge = query.get("hub.challenge", [""])[0].encode()
+
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(challenge)))
+            self.end_headers()
+            self.wfile.write(challenge)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            if WEBSUB_SECRET:
+                expected = "sha1=" + hmac.new(WEBSUB_SECRET.encode(), body, hashlib.sha1).hexdigest()
+
+                if not hmac.compare_digest(expected, self.headers.get("X-Hub-Signature", "")):
+                    log.warning("Dropping notification with a bad signature")
+
+                    # the spec wants a 2xx either way
+                    self.send_response(202)
+                    self.end_headers()
+                    return
+
+            self.send_response(204)
+            self.end_headers()
+
+            try:
+                videos = parse_feed(body)
+            except ElementTree.ParseError as e:
+                log.error(f'Bad notification: {e}')
+                return
+
+            with lock:
+                tracker = QuotaTracker()
+
+                pending = handle([(v, channels[v.channel_id]) for v in videos if v.channel_id in channels], store)
+
+                if pending:
+                    pending = enrich(pending, tracker)
+
+                publish(pending, store)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    if WEBSUB_CALLBACK:
+        threading.Thread(target=websub_subscribe, args=(list(channels.values()),), daemon=True).start()
+    else:
+        log.warning("WEBSUB_CALLBACK not set, not subscribing")
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+        log.info(f'Serving metrics on :{METRICS_PORT}/metrics')
 
-        for video in get_videos(channel):
-            log.debug(f"  - {video.title}")
-            if video.id in seen:
-                log.debug(f"    - SEEN")
+    log.info(f'Listening for WebSub notifications on :{WEBSUB_PORT}')
 
-                continue
+    ThreadingHTTPServer(("", WEBSUB_PORT), Handler).serve_forever()
 
-            if not POPULATE_SEEN:
-                post(video, channel)
-            else:
-                log.info(f'POPULATING SEEN - {video.id}')
+def thread_http():
+    # httplib2 isnt thread safe, give each worker its own connection
+    if not hasattr(_local, "http"):
+        from googleapiclient.http import build_http
 
-            if not DRY_RUN:
-                seen.add(video.id)
+        _local.http = build_http()
 
-def get_videos(channel: WatchedChannel) -> List[Video]:
+    return _local.http
+
+_local = threading.local()
+
+def get_videos(channel: WatchedChannel, tracker: QuotaTracker) -> List[Video]:
     try:
         yesterday = dt.now(datetime.UTC) - timedelta(hours = 24)
-        r = youtube.activities().list(
+        request = youtube.activities().list(
                 channelId = channel.id,
                 publishedAfter = yesterday.isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
                 part = "snippet, contentDetails",
-            ).execute()
+            )
+
+        tracker.spend("activities.list")
+
+        with metrics.request("youtube", "activities.list"):
+            r = request.execute(http = thread_http())
 
         return [Video.from_api(x) for x in r.get("items") if x["snippet"]["type"] == 'upload']
 
     except HttpError as e:
         for err in e.error_details:
             if err.get('reason') == 'quotaExceeded':
-                log.critical('YouTube API quota exceeded, exiting')
-                sys.exit(1)
+                raise QuotaExceeded()
 
         log.error(e)
 
@@ -197,10 +580,14 @@ def get_videos(channel: WatchedChannel) -> List[Video]:
         traceback.print_exc()
         return []
 
-def post(video, channel):
+@cache
+def bot_user():
+    return reddit.user.me()
+
+def format_title(video: Video, channel: WatchedChannel) -> Optional[str]:
     for f in channel.title_reject:
         if f in video.title:
-            return False
+            return None
 
     sub = ['[Vinesauce]', '[VINESAUCE]']
 
@@ -211,26 +598,21 @@ def post(video, channel):
     for s in sub:
         video_title = video_title.replace(s, '')
 
-    video_title = f'[{channel.name}] {video_title.strip()}'
+    return f'[{channel.name}] {video_title.strip()}'
 
-    if DRY_RUN:
-        log.info(f'DRY RUN - Post {video_title}')
+def unsticky_bot_posts() -> None:
+    # stickies are always at the top of hot, one listing call instead of a request per slot
+    for s in subreddit.hot(limit=STICKY_SLOTS):
+        if not s.stickied:
+            break
 
-        return
+        if s.author == bot_user():
+            s.mod.sticky(state=False)
 
-    while True:
+def submit(video: Video, video_title: str) -> Tuple[bool, Optional[praw.models.Submission]]:
+    # whether the video is on the subreddit now, and the submission if this made it
+    for attempt in range(SUBMIT_RETRIES):
         try:
-            # Unsticky any bot posts
-            for i in reversed(range(1, 7)):
-                try:
-                    s = subreddit.sticky(number=i)
-
-                    if s.author == reddit.user.me():
-                        s.mod.sticky(state=False)
-
-                except prawcore.NotFound as e:
-                    continue
-
             s = subreddit.submit(
                 video_title,
                 url = video.url,
@@ -238,18 +620,82 @@ def post(video, channel):
                 resubmit = True
             )
 
-            s.mod.sticky(bottom=True, state=True)
-
             log.info(f'Posted: {video_title} {s.shortlink}')
-            break
+
+            if STATS_POSTS:
+                stats.emit(
+                    title=f"Posted: {video_title}",
+                    description=f"{video.channel_title}\n{video.url}\n{s.shortlink}",
+                    color=0xFF0000,
+                )
+
+            return True, s
 
         except praw.exceptions.APIException as e:
             if(e.error_type == 'ALREADY_SUB'):
                 log.warning(f'Already Posted: {video_title}')
-                break
+                return True, None
+
+            log.error(f'Error submitting: {video_title} {e}')
 
         except Exception as e:
             log.error(f'Error submitting: {video_title} {e}')
 
+        if attempt + 1 < SUBMIT_RETRIES:
+            time.sleep(2 ** attempt)
+
+    log.error(f'Giving up on: {video_title}')
+
+    return False, None
+
+def post(pending: List[Tuple[Video, WatchedChannel]]) -> List[str]:
+    # returns the ids that are done with, posted, already posted or filtered out by title
+    posts = []
+    done = []
+
+    for video, channel in pending:
+        if title := format_title(video, channel):
+            posts.append((video, title))
+        else:
+            done.append(video.id)
+
+    if DRY_RUN:
+        for _, video_title in posts:
+            log.info(f'DRY RUN - Post {video_title}')
+
+        return []
+
+    if not posts:
+        return done
+
+    # only now is reddit needed, runs with nothing new never build it
+    log.info(f'Logged into reddit as /u/{bot_user()} on /r/{subreddit.display_name}')
+
+    submitted = []
+
+    for video, title in posts:
+        ok, s = submit(video, title)
+
+        if ok:
+            done.append(video.id)
+
+        if s:
+            submitted.append(s)
+
+    if submitted:
+        # only the newest video stays stickied, a failure here must not keep what was posted from being marked seen
+        try:
+            unsticky_bot_posts()
+            submitted[-1].mod.sticky(bottom=True, state=True)
+
+        except Exception as e:
+            log.error(f'Error stickying {submitted[-1].shortlink}: {e}')
+
+    return done
+
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        if METRICS_FILE:
+            metrics.write_textfile(METRICS_FILE)